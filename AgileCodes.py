@@ -1,35 +1,207 @@
-import requests
+import os
+import re
+import json
+import time
+import logging
+import argparse
+import Files
+import Octopus
+import OctopusClient
 
-# Dumps all the publicly available Octopus Tariffs along with their code and description
+# Lists the publicly available Octopus Tariffs along with their code and description.
+# The product catalogue is fetched (all pages, concurrently) and cached locally, then indexed by code, brand,
+# direction and variable flag so it can be filtered without scrolling the whole list, e.g. the current Agile
+# import tariffs:
+#
+#     python AgileCodes.py --agile -d IMPORT
+#
+# AgileWall.py uses the cached catalogue to check the --tariff code, without another call to the Octopus API.
+
+_LOGGER = logging.getLogger("AgileWall")
+
+PRODUCTS_URL = f"{Octopus.OCTOPUS_API_URL}/products/"
+DEFAULT_CATALOGUE_FILE = "octopus_products.json"
+DEFAULT_TTL_HOURS = 24
+PAGE_SIZE = 100
+PAGE_WORKERS = 4
+# Agile product codes end with the date of the tariff version, e.g. AGILE-23-12-06 or AGILE-FLEX-22-11-25
+AGILE_CODE = re.compile(r"AGILE(-[A-Z]+)*-\d{2}-\d{2}-\d{2}")
 
 
 class Product:
-    def __init__(self, code, direction, full_name, description, is_variable, brand):
+    def __init__(self, code, direction, full_name, description, is_variable, brand, available_from=None,
+                 available_to=None):
         self.code = code
         self.direction = direction
         self.full_name = full_name
         self.description = description
         self.is_variable = is_variable
         self.brand = brand
+        self.available_from = available_from
+        self.available_to = available_to
 
     def __repr__(self):
         return (f"{self.code}, {self.full_name}, {str(self.is_variable)}, {str(self.brand)}, "
                 f"{str(self.direction)} \n {str(self.description)}")
 
+    @classmethod
+    def from_json(cls, product):
+        return cls(product["code"], product["direction"], product["full_name"], product["description"],
+                   product["is_variable"], product["brand"], product.get("available_from"),
+                   product.get("available_to"))
+
+    def is_agile(self):
+        return self.code.startswith("AGILE")
+
+
+class ProductCatalogue:
+
+    def __init__(self, products, fetched_at):
+        self.products = products
+        self.fetched_at = fetched_at
+        self.by_code = {product.code: product for product in products}
+        # Indexes of product codes by each attribute value
+        self.by_brand = self.__index(lambda product: product.brand)
+        self.by_direction = self.__index(lambda product: product.direction)
+        self.by_variable = self.__index(lambda product: product.is_variable)
+
+    def __index(self, key):
+        index = {}
+        for product in self.products:
+            index.setdefault(key(product), set()).add(product.code)
+        return index
+
+    def lookup(self, code):
+        return self.by_code.get(code)
+
+    def query(self, brand=None, direction=None, is_variable=None, agile=False, text=None):
+        codes = set(self.by_code)
+        if brand is not None:
+            codes &= self.by_brand.get(brand, set())
+        if direction is not None:
+            codes &= self.by_direction.get(direction, set())
+        if is_variable is not None:
+            codes &= self.by_variable.get(is_variable, set())
+
+        products = [self.by_code[code] for code in sorted(codes)]
+        if agile:
+            products = [product for product in products if product.is_agile()]
+        if text:
+            text = text.lower()
+            products = [product for product in products
+                        if text in product.full_name.lower() or text in product.description.lower()]
+        return products
+
+
+def fetch_products(client):
+    # All pages of the product catalogue - the first page gives the count, then the rest are fetched concurrently
+    from concurrent.futures import ThreadPoolExecutor
+
+    first = client.get_json(f"{PRODUCTS_URL}?page_size={PAGE_SIZE}")
+    results = list(first["results"])
+    pages = -(-first["count"] // PAGE_SIZE) if first.get("next") else 1
+    if pages > 1:
+        with ThreadPoolExecutor(PAGE_WORKERS) as pool:
+            for page in pool.map(client.get_json,
+                                 [f"{PRODUCTS_URL}?page_size={PAGE_SIZE}&page={page}" for page in range(2, pages + 1)]):
+                results += page["results"]
+    return results
+
+
+def fetch_product(client, code):
+    # One product by its code - including retired products, which the catalogue doesn't list
+    return Product.from_json(client.get_json(f"{PRODUCTS_URL}{code}/"))
+
+
+def load_catalogue(file_name=DEFAULT_CATALOGUE_FILE, ttl_hours=DEFAULT_TTL_HOURS, refresh=False, offline=False):
+    # The cached catalogue if it is younger than the TTL (or offline - whatever its age), otherwise it is
+    # fetched from Octopus and cached. Returns None if there is no catalogue to use.
+    cached = None
+    if os.path.exists(file_name):
+        with open(file_name) as f:
+            cached = json.load(f)
+
+    if cached is not None and not refresh and (offline or time.time() - cached["fetched_at"] < ttl_hours * 3600):
+        return ProductCatalogue([Product.from_json(product) for product in cached["products"]], cached["fetched_at"])
+    if offline:
+        return None
+
+    products = fetch_products(OctopusClient.get_client(_LOGGER))
+    fetched_at = time.time()
+
+    Files.atomic_write(file_name, json.dumps({"fetched_at": fetched_at, "products": products}, separators=(",", ":")))
+
+    return ProductCatalogue([Product.from_json(product) for product in products], fetched_at)
+
+
+def check_tariff(tariff_code, file_name=DEFAULT_CATALOGUE_FILE):
+    # Check an Agile tariff code against the cached catalogue, without calling the Octopus API.
+    # Returns None if the code is known (or there is no cached catalogue to check against), otherwise a message.
+    # The catalogue only lists the products open to new customers, so a code shaped like an Agile product code
+    # is accepted - existing customers stay on older (retired) Agile versions.
+    if AGILE_CODE.fullmatch(tariff_code):
+        return None
+    try:
+        catalogue = load_catalogue(file_name, offline=True)
+    except (OSError, ValueError, KeyError) as e:
+        _LOGGER.warning(f"Can't read the product catalogue {file_name}: {e!r}")
+        return None
+    if catalogue is None or catalogue.lookup(tariff_code) is not None:
+        return None
+
+    current = ", ".join(product.code for product in catalogue.query(direction="IMPORT", agile=True))
+    return (f"Tariff {tariff_code} is not an Agile product code, or in the Octopus product catalogue (current "
+            f"Agile import tariffs: {current or 'none'})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the publicly available Octopus tariffs")
+    parser.add_argument("-c", "--code", default=None, dest="code", type=str,
+                        help="Show one product code (retired products are looked up by their code)")
+    parser.add_argument("-b", "--brand", default=None, dest="brand", type=str,
+                        help="Only products of this brand, e.g. OCTOPUS_ENERGY")
+    parser.add_argument("-d", "--direction", default=None, dest="direction", type=str.upper,
+                        choices=("IMPORT", "EXPORT"), help="Only import or export products")
+    parser.add_argument("-A", "--agile", help="Only Agile products", action="store_true", default=False)
+    parser.add_argument("-V", "--variable", dest="is_variable", action="store_const", const=True, default=None,
+                        help="Only variable rate products")
+    parser.add_argument("-F", "--fixed", dest="is_variable", action="store_const", const=False,
+                        help="Only fixed rate products")
+    parser.add_argument("-q", "--query", default=None, dest="text", type=str,
+                        help="Only products with this text in their name or description")
+    parser.add_argument("-s", "--codes_only", help="List just the product codes", action="store_true", default=False)
+    parser.add_argument("-f", "--catalogue_file", default=DEFAULT_CATALOGUE_FILE, dest="catalogue_file", type=str,
+                        help=f"Local product catalogue cache (default {DEFAULT_CATALOGUE_FILE})")
+    parser.add_argument("-T", "--ttl", default=DEFAULT_TTL_HOURS, dest="ttl", type=float,
+                        help=f"Hours before the cached catalogue is fetched again (default {DEFAULT_TTL_HOURS})")
+    parser.add_argument("-r", "--refresh", help="Fetch the catalogue from Octopus now", action="store_true",
+                        default=False)
+    args = parser.parse_args()
+
+    try:
+        product_catalogue = load_catalogue(args.catalogue_file, args.ttl, args.refresh)
+    except (OctopusClient.OctopusError, KeyError, TypeError) as e:
+        print(f"Failed to fetch the Rate Codes from the Octopus API: {e!r}")
+        exit(-2)
+
+    if args.code:
+        rate_codes = [product_catalogue.lookup(args.code)] if product_catalogue.lookup(args.code) else []
+        if not rate_codes:
+            # Retired products aren't in the catalogue, but can still be looked up by their code
+            try:
+                rate_codes = [fetch_product(OctopusClient.get_client(_LOGGER), args.code)]
+            except (OctopusClient.OctopusError, KeyError, TypeError) as e:
+                _LOGGER.info(f"Product {args.code} lookup failed: {e!r}")
+    else:
+        rate_codes = product_catalogue.query(args.brand, args.direction, args.is_variable, args.agile, args.text)
 
-headers = {"content-type": "application/json"}
-url = f"https://api.octopus.energy/v1/products"
+    if len(product_catalogue.products) == 0:
+        print(f"No Rate Codes Returned from Octopus API")
+        exit(1)
 
-r = requests.get(url, headers=headers)
-results = r.json()["results"]
-if len(results) == 0:
-    print(f"No Rate Codes Returned from Octopus API")
-    exit(1)
+    if len(rate_codes) == 0:
+        print(f"No matching Rate Codes found")
+        exit(1)
 
-rate_codes = []
-for rate in results:
-    rate_codes.append(Product(rate["code"], rate["direction"], rate["full_name"],
-                              rate["description"], rate["is_variable"], rate["brand"]))
-    
-for item in rate_codes:
-    print(item)
+    for item in rate_codes:
+        print(item.code if args.codes_only else item)
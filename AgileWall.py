@@ -1,15 +1,30 @@
+import time
+_START = time.perf_counter()
+
+import os
 import sys
 import json
+import threading
 import logging
 import Octopus
-import Tesla
 import argparse
-import ChartGen
+import RateCache
+import TariffState
+import Daemon
+import Metrics
+import Thresholds
+import AgileCodes
+# Tesla (teslapy & its OAuth stack) and ChartGen are imported only on the code paths which use them, so runs
+# which never write to the Powerwall start quickly
 
 VERSION = "0.4"
+STARTUP_BUDGET_MS = 50      # Time allowed for imports & setup before the pipeline starts
+TESLA_CACHE_FILE = "cache.json"     # TeslaPy's token cache - once it exists, the sign on needs no prompts
 
 _LOGGER = logging.getLogger("AgileWall")
 
+BAND_NAMES = {"SUPER_OFF_PEAK": "Super Off-Peak", "OFF_PEAK": "Off-Peak", "PARTIAL_PEAK": "Mid-Peak", "ON_PEAK": "Peak"}
+
 if not sys.version_info >= (3, 11):
     print("This program uses features which require Python 3.11 or later.")
     exit(-1)
@@ -22,27 +37,121 @@ parser.add_argument("-a", "--area", nargs=1, dest="area", type=str, required=Tru
                     help="DNO Area Code - see https://energy-stats.uk/dno-region-codes-explained/")
 parser.add_argument("-i", "--tesla_id", nargs=1, dest="tesla_id", type=str, required=True,
                     help="Tesla logon ID - used to sign on to your Tesla account.")
+parser.add_argument("-b", "--battery", default=None, dest="battery", type=str,
+                    help="Powerwall to update (id, energy site id or site name) - defaults to the first battery.")
 parser.add_argument("-v", "--verbose", help="Verbose Output", action="store_true", default=False)
 parser.add_argument("-L", "--list_only", help="List Changes, but don't send to Powerwall",
                     action="store_true", default=False)
 parser.add_argument("-d", "--delta", default=0, dest="delta", type=int, 
                     help="Days into the past to fetch Agile Schedule - Does not update Powerwall (Useful for testing)")
+parser.add_argument("--days", default=1, dest="days", type=int,
+                    help="Agile days (ending with the -d day) to build the schedule from, with separate ToU periods "
+                    "for each day of the week - sent to the Powerwall in one update (default 1).")
 parser.add_argument("-c", "--chart", help="Generate Chart Data", action="store_true", default=False)
+parser.add_argument("-C", "--chart_only", help="Generate Chart Data only - does not read or update the Powerwall",
+                    action="store_true", default=False)
 parser.add_argument("-o", "--chart_path", default=".", dest="chart_path", type=str, 
                     help="Path to write the chart files to.")
+parser.add_argument("-j", "--chart_json", help="Also write the chart data as a single compact JSON file "
+                    "(agile_chart.json)", action="store_true", default=False)
+parser.add_argument("--serve", default=0, dest="serve", type=int,
+                    help="Serve the chart from memory on this HTTP port, and keep running (default 0 - off).")
+parser.add_argument("--serve_host", default="0.0.0.0", dest="serve_host", type=str,
+                    help="Address for the chart server to listen on (default all interfaces).")
+parser.add_argument("--chart_history", default=0, dest="chart_history", type=int,
+                    help="Days of Agile rate history to keep alongside the chart data (default 0 - none).")
 parser.add_argument("-P", "--peak", help="Combine Mid-Peak & Peak Bands", action="store_true", default=False)
+parser.add_argument("-T", "--thresholds", default=Thresholds.HEURISTIC, dest="thresholds",
+                    choices=Thresholds.STRATEGIES, help="Band threshold strategy - fixed fractions of the average "
+                    "price (heuristic, the default), or the best trade off of price fit against ToU periods (optimal)")
+parser.add_argument("--period_penalty", default=Thresholds.DEFAULT_PERIOD_PENALTY, dest="period_penalty",
+                    type=float, help="Optimal thresholds - price error (pence squared) worth one extra ToU period "
+                    f"(default {Thresholds.DEFAULT_PERIOD_PENALTY})")
+parser.add_argument("--catalogue_file", default=AgileCodes.DEFAULT_CATALOGUE_FILE, dest="catalogue_file", type=str,
+                    help="Octopus product catalogue cached by AgileCodes.py, used to check the tariff code.")
+parser.add_argument("-k", "--cache_file", default=RateCache.DEFAULT_CACHE_FILE, dest="cache_file", type=str,
+                    help="Local Agile rate cache file - previously fetched rates are served from here.")
+parser.add_argument("-s", "--state_file", default=TariffState.DEFAULT_STATE_FILE, dest="state_file", type=str,
+                    help="File recording the tariff last sent to each Powerwall.")
+parser.add_argument("-S", "--skip_read", help="Don't read the Powerwall tariff if the schedule is unchanged since "
+                    "the last update sent", action="store_true", default=False)
+parser.add_argument("-D", "--daemon", help="Keep running, and update the Powerwall as soon as each day's Agile "
+                    "rates are published", action="store_true", default=False)
+parser.add_argument("--status_file", default=Daemon.DEFAULT_STATUS_FILE, dest="status_file", type=str,
+                    help="Daemon mode status file, reporting the next scheduled action.")
+parser.add_argument("--publish_time", default=Daemon.DEFAULT_PUBLISH_TIME, dest="publish_time", type=str,
+                    help="Daemon mode - local time (HH:MM) to start polling for the next day's Agile rates.")
+parser.add_argument("-K", "--no_cache", help="Always fetch Agile rates from Octopus, bypassing the local cache",
+                    action="store_true", default=False)
+parser.add_argument("--metrics_file", default=None, dest="metrics_file", type=str,
+                    help=f"JSON lines file each run's stage timings & outcome are appended to (default "
+                    f"{Metrics.DEFAULT_JSON_FILE}, empty to disable). Replays only write it if given.")
+parser.add_argument("--prom_file", default=None, dest="prom_file", type=str,
+                    help=f"Prometheus text format metrics file, e.g. in the node exporter textfile directory (default "
+                    f"{Metrics.DEFAULT_PROM_FILE}, empty to disable). Replays only write it if given.")
+parser.add_argument("--record", default=None, dest="record", type=str,
+                    help="Record the Octopus & Tesla API traffic of this run to a file (bypasses the rate cache).")
+parser.add_argument("--replay", default=None, dest="replay", type=str,
+                    help="Replay a recorded run's Octopus & Tesla API traffic - no network calls, and the "
+                    "Powerwall isn't updated.")
+parser.add_argument("--replay_latency", default="recorded", dest="replay_latency", type=str,
+                    help="Latency of each replayed API call in milliseconds, or 'recorded' (the default) to use the "
+                    "latency recorded for it.")
 
 args = parser.parse_args()
 
 TARIFF = args.tariff[0]
 AREA_CODE = args.area[0]
 TESLA_ID = args.tesla_id[0]
+BATTERY_ID = args.battery
 VERBOSE = args.verbose
 LIST_ONLY = args.list_only
 DAY_OFFSET = args.delta
-CHART_GEN = args.chart
+DAYS = args.days
+CHART_ONLY = args.chart_only
+CHART_GEN = args.chart or CHART_ONLY
 CHART_PATH = args.chart_path
+CHART_JSON = args.chart_json
+CHART_HISTORY = args.chart_history
+SERVE_PORT = args.serve
+SERVE_HOST = args.serve_host
 PEAK_COMBINE = args.peak
+THRESHOLDS = args.thresholds
+PERIOD_PENALTY = args.period_penalty
+CACHE_FILE = None if args.no_cache else args.cache_file
+STATE_FILE = args.state_file
+SKIP_READ = args.skip_read
+DAEMON = args.daemon
+STATUS_FILE = args.status_file
+PUBLISH_TIME = args.publish_time
+METRICS_FILE = args.metrics_file
+PROM_FILE = args.prom_file
+RECORD_FILE = args.record
+REPLAY_FILE = args.replay
+REPLAY_LATENCY = args.replay_latency
+
+if RECORD_FILE and REPLAY_FILE:
+    parser.error("--record and --replay can't be used together")
+if REPLAY_LATENCY != "recorded":
+    try:
+        REPLAY_LATENCY = float(REPLAY_LATENCY)
+    except ValueError:
+        parser.error(f"--replay_latency must be a number of milliseconds or 'recorded', not {REPLAY_LATENCY}")
+if RECORD_FILE or REPLAY_FILE:
+    CACHE_FILE = None   # Every Octopus request is recorded / replayed, rather than served from the rate cache
+# Replays don't add to the production run & request counters - their metrics are only written to files given
+# for them
+if METRICS_FILE is None:
+    METRICS_FILE = "" if REPLAY_FILE else Metrics.DEFAULT_JSON_FILE
+if PROM_FILE is None:
+    PROM_FILE = "" if REPLAY_FILE else Metrics.DEFAULT_PROM_FILE
+
+if DAEMON and DAY_OFFSET != 0:
+    print("Daemon mode always fetches the next day's Agile rates, the -d option can't be used.")
+    exit(-1)
+
+if not 1 <= DAYS <= 7:
+    parser.error("--days must be from 1 to 7")
 
 if DAY_OFFSET != 0:  # Requesting past days Agile schedules means we must not update the Powerwall
     LIST_ONLY = True
@@ -51,144 +160,316 @@ if LIST_ONLY:       # Turn on verbose output if we are just listing the changes
     VERBOSE = True
 
 _LOGGER.info(f"Tariff = {TARIFF}")
+# Check the tariff code against the product catalogue, if AgileCodes.py has cached it (no network call)
+tariff_warning = AgileCodes.check_tariff(TARIFF, args.catalogue_file)
+if tariff_warning:
+    _LOGGER.warning(tariff_warning)
+    print(f"Warning: {tariff_warning}")
 _LOGGER.info(f"DNO Area = {AREA_CODE}")
 _LOGGER.info(f"Tesla ID = {TESLA_ID}")
 
-# Create the Agile instance and pass in the Logger we are using
-agile = Octopus.Agile(_LOGGER)
-
-# Fetch tomorrow's Agile Tariff - This function also sets the various thresholds
-# which are used to bucket the time slots later.
-agile_time_slots = agile.get_agile_rates(TARIFF, AREA_CODE, 0-DAY_OFFSET)
-if not agile_time_slots:
-    print("No Agile Tariff found for today, please try again later.")
-    exit(-2)
-
-# Sort the time slots into one of the 4 Utility Plan codes
-SuperOffPeak = agile.get_super_off_peak_slots(agile_time_slots)
-OffPeak = agile.get_off_peak_slots(agile_time_slots)
-
-# Are we combining the Mid-Peak & Peak Tariff Bands?
-if PEAK_COMBINE:
-    Peak = agile.get_combined_peak_slots(agile_time_slots)
-    MidPeak = []
+# Record or replay the Octopus & Tesla API traffic (if enabled)
+recording = None
+octopus_client = None
+if REPLAY_FILE:
+    import Recording
+    try:
+        recording = Recording.Recording.load(REPLAY_FILE)
+    except Recording.RecordingError as e:
+        print(e)
+        exit(-1)
+    octopus_client = recording.replay_client(REPLAY_LATENCY)
+elif RECORD_FILE:
+    import Recording
+    import OctopusClient
+    recording = Recording.Recording()
+    octopus_client = recording.recording_client(OctopusClient.get_client(_LOGGER))
+
+# Create the Agile instance and pass in the Logger we are using, plus the local rate cache (if enabled)
+rate_cache = RateCache.RateCache(CACHE_FILE) if CACHE_FILE else None
+agile = Octopus.Agile(_LOGGER, rate_cache, thresholds=THRESHOLDS, period_penalty=PERIOD_PENALTY, client=octopus_client,
+                      today=recording.today() if REPLAY_FILE else None)
+
+# Replayed runs start from the recorded run's tariff state, and don't write it back to the state file
+if REPLAY_FILE:
+    tariff_state = TariffState.TariffState(None, recording.data["tariff_state"])
 else:
-    MidPeak = agile.get_mid_peak_slots(agile_time_slots)
-    Peak = agile.get_peak_slots(agile_time_slots)
-
-if VERBOSE:
-    print()
-    print(f"Time Slots: {len(agile_time_slots)}")
-    print("==============")
-    agile.print_rate_slots("Super Off-Peak", SuperOffPeak)
-    agile.print_rate_slots("Off-Peak", OffPeak)
-    agile.print_rate_slots("Mid-Peak", MidPeak)
-    agile.print_rate_slots("Peak", Peak)
-
-# Process each bucket and merge any adjacent time slots
-SuperOffPeak = agile.merge_adjacent_slots(SuperOffPeak)
-OffPeak = agile.merge_adjacent_slots(OffPeak)
-MidPeak = agile.merge_adjacent_slots(MidPeak)
-Peak = agile.merge_adjacent_slots(Peak)
-
-if VERBOSE:
-    slot_count = len(SuperOffPeak)+len(OffPeak)+len(MidPeak)+len(Peak)
-    print()
-    print(f"Merged Slots: {slot_count}")
-    print("================")
-    agile.print_rate_slots("Super Off-Peak", SuperOffPeak)
-    agile.print_rate_slots("Off-Peak", OffPeak)
-    agile.print_rate_slots("Mid-Peak", MidPeak)
-    agile.print_rate_slots("Peak", Peak)
-
-# Build the Tesla Time of Use data and calculate the average rate for each rate type
-tou_super = agile.build_tou_periods(SuperOffPeak)
-rate_super = agile.get_average_rate(SuperOffPeak)
-if VERBOSE:
-    agile.print_tou("Super Off-Peak", rate_super, tou_super)
-
-tou_off_peak = agile.build_tou_periods(OffPeak)
-rate_off_peak = agile.get_average_rate(OffPeak)
-if VERBOSE:
-    agile.print_tou("Off-Peak", rate_off_peak, tou_off_peak)
-
-tou_mid_peak = agile.build_tou_periods(MidPeak)
-tou_peak = agile.build_tou_periods(Peak)
-
-if PEAK_COMBINE:
-    rate_mid_peak = round(agile.MAX, 3)
-    rate_peak = round(agile.MAX, 3)
+    tariff_state = TariffState.TariffState(STATE_FILE)
+    if RECORD_FILE:
+        recording.data["tariff_state"] = dict(tariff_state.state)
+
+# The chart server (if enabled) runs in the background for the lifetime of the process
+chart_server = None
+if SERVE_PORT:
+    import ChartServer
+    chart_server = ChartServer.ChartServer(_LOGGER, SERVE_PORT, SERVE_HOST)
+
+# The Powerwall session is created when first needed, then kept for the lifetime of the process
+_powerwall = None
+_powerwall_lock = threading.Lock()
+_tesla_pool = None
+
+
+def get_powerwall():
+    global _powerwall
+    with _powerwall_lock:
+        if _powerwall is None:
+            import Tesla
+            tesla = None
+            if REPLAY_FILE:
+                tesla = recording.replay_tesla(REPLAY_LATENCY)
+            elif RECORD_FILE:
+                import teslapy
+                tesla = recording.recording_tesla(teslapy.Tesla(TESLA_ID))
+            _powerwall = Tesla.Powerwall(TESLA_ID, battery_id=BATTERY_ID, tesla=tesla)
+        return _powerwall
+
+
+def read_powerwall_tariff(metrics):
+    # Sign on to Tesla (if not already), and fetch the current Powerwall Battery Tariff data
+    with metrics.stage("tesla_connect"):
+        powerwall = get_powerwall()
+    with metrics.stage("tesla_get_tariff"):
+        return powerwall, powerwall.get_tariff()
+
+
+def start_powerwall_read(metrics):
+    # Read the Powerwall tariff in the background, while the Agile rates are fetched & processed - returns a
+    # Future, or None if the read should wait until it is needed
+    global _tesla_pool
+    if LIST_ONLY or CHART_ONLY or SKIP_READ:
+        return None     # No Tesla API calls at all, or only if the schedule has changed
+    if _powerwall is None and not REPLAY_FILE and not os.path.exists(TESLA_CACHE_FILE):
+        return None     # First sign on is interactive - keep its prompts apart from the rest of the output
+
+    if _tesla_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _tesla_pool = ThreadPoolExecutor(1)
+    return _tesla_pool.submit(read_powerwall_tariff, metrics)
+
+
+# Run the pipeline once, recording the timings of each stage - returns the program exit code
+def run_pipeline():
+    metrics = Metrics.RunMetrics()
+    agile.metrics = metrics
+    exit_code = -1
+    try:
+        exit_code = _run_pipeline(metrics)
+    finally:
+        agile.metrics = None
+        metrics.finish(exit_code)
+        _LOGGER.info(f"Run metrics = {metrics.to_dict()}")
+        try:
+            if METRICS_FILE:
+                metrics.write_json_line(METRICS_FILE)
+            if PROM_FILE:
+                metrics.write_prometheus(PROM_FILE)
+        except OSError as e:
+            # Metrics must never stop the Powerwall being updated
+            _LOGGER.error(f"Failed to write run metrics: {e}")
+        if RECORD_FILE:
+            try:
+                recording.save(RECORD_FILE)
+            except OSError as e:
+                _LOGGER.error(f"Failed to write the recording {RECORD_FILE}: {e}")
+    return exit_code
+
+
+# Fetch the Agile rates, build the Powerwall schedule and send it - returns the program exit code
+def _run_pipeline(metrics):
+    # The Octopus fetch and the Tesla read don't depend on each other, so the Tesla read starts first
+    powerwall_read = start_powerwall_read(metrics)
+
+    # Fetch tomorrow's Agile Tariff - This function also sets the various thresholds
+    # which are used to bucket the time slots later.
+    with metrics.stage("octopus_fetch"):
+        agile_time_slots = agile.get_agile_rates(TARIFF, AREA_CODE, 0-DAY_OFFSET, DAYS)
+    metrics.set_value("slots_fetched", len(agile_time_slots))
+    if rate_cache is not None:
+        cache_stats = rate_cache.stats()
+        _LOGGER.info(f"Rate cache = {cache_stats}")
+        metrics.set_value("cache_hits", cache_stats["hits"])
+        metrics.set_value("cache_misses", cache_stats["misses"])
+    if not agile_time_slots:
+        print("No Agile Tariff found for today, please try again later.")
+        return -2
+
+    # Sort the time slots into one of the 4 Utility Plan codes, merge any adjacent time slots in each bucket,
+    # then build the Tesla Time of Use data and calculate the average rate for each rate type
+    with metrics.stage("build_schedule"):
+        schedule = agile.build_schedule(agile_time_slots, PEAK_COMBINE, DAYS > 1)
+    metrics.set_value("slots_merged", sum(len(schedule.merged[band]) for band in Octopus.TOU_BANDS))
+    metrics.set_value("tou_periods", sum(len(periods) for periods in schedule.tou_periods.values()))
+
+    if VERBOSE:
+        print()
+        print(f"Time Slots: {len(agile_time_slots)}")
+        print("==============")
+        for band in Octopus.TOU_BANDS:
+            agile.print_rate_slots(BAND_NAMES[band], schedule.slots[band])
+
+        slot_count = sum(len(schedule.merged[band]) for band in Octopus.TOU_BANDS)
+        print()
+        print(f"Merged Slots: {slot_count}")
+        print("================")
+        for band in Octopus.TOU_BANDS:
+            agile.print_rate_slots(BAND_NAMES[band], schedule.merged[band])
+
+        for band in Octopus.TOU_BANDS:
+            agile.print_tou(BAND_NAMES[band], schedule.rates[band], schedule.tou_periods[band])
+
+    # The Rate Type / Energy Charges structure
+    #    - this is stored in a separate structure from the ToU time slots
+    tou_rates = schedule.tou_rates
+
+    # The band thresholds are kept with each day of the chart history
+    band_limits = (agile.LIMIT_SUPER_OFF_PEAK, agile.LIMIT_OFF_PEAK, agile.LIMIT_MID_PEAK)
+
+    if CHART_GEN:
+        with metrics.stage("charts"):
+            import ChartGen
+            if not ChartGen.export_agile_data(agile_time_slots, CHART_PATH):
+                print("Error writing chart time slot data.")
+                return -4
+
+            if not ChartGen.export_agile_rates(agile.MIN, agile.MAX, agile.LIMIT_SUPER_OFF_PEAK,
+                                               agile.LIMIT_OFF_PEAK, agile.LIMIT_MID_PEAK, PEAK_COMBINE, CHART_PATH):
+                print("Error writing chart pw rate data.")
+                return -4
+
+            # The page finds the history levels through agile_chart.json, so it is always written with a history
+            if CHART_JSON or CHART_HISTORY > 0:
+                if not ChartGen.export_chart_json(agile_time_slots, agile.MIN, agile.MAX, agile.LIMIT_SUPER_OFF_PEAK,
+                                                  agile.LIMIT_OFF_PEAK, agile.LIMIT_MID_PEAK, PEAK_COMBINE,
+                                                  CHART_PATH, CHART_HISTORY):
+                    print("Error writing chart JSON data.")
+                    return -4
+            else:
+                ChartGen.remove_chart_json(CHART_PATH)
+
+    if chart_server is not None:
+        with metrics.stage("chart_publish"):
+            import ChartGen
+            history = ChartGen.export_agile_history(agile_time_slots, CHART_PATH, CHART_HISTORY, band_limits) \
+                if CHART_HISTORY > 0 else []
+            levels = ChartGen.history_levels(history, CHART_HISTORY) if history else []
+            limits = (agile.MIN, agile.MAX, agile.LIMIT_SUPER_OFF_PEAK, agile.LIMIT_OFF_PEAK, agile.LIMIT_MID_PEAK,
+                      PEAK_COMBINE)
+            files = {"agile_data.js": ChartGen.agile_data_text(agile_time_slots),
+                     "powerwall_rates.js": ChartGen.powerwall_rates_text(*limits),
+                     ChartGen.CHART_JSON_FILE: ChartGen.chart_json_text(agile_time_slots, *limits,
+                                                                         {level: name for level, name, _ in levels})}
+            files.update({name: text for _, name, text in levels})
+            chart_server.publish(files)
+
+    # Runs which never write to the Powerwall don't use the Tesla API at all
+    if LIST_ONLY or CHART_ONLY:
+        if VERBOSE:
+            print("New ToU Rates")
+            print("=============")
+            print(json.dumps(tou_rates, indent=4))
+
+            print("New ToU Periods")
+            print("===============")
+            print(json.dumps(schedule.tou_periods, indent=4))
+
+        print(f"{'List' if LIST_ONLY else 'Chart'} Mode Complete - No Updates Applied.")
+        return 1
+
+    # Skip the Tesla API altogether if this schedule is the one we last sent to the Powerwall
+    new_tariff = TariffState.normalise(tou_rates, schedule.tou_periods)
+    new_digest = TariffState.digest(new_tariff)
+    state_key = TariffState.TariffState.key(TESLA_ID, BATTERY_ID)
+    if SKIP_READ and tariff_state.get_digest(state_key) == new_digest:
+        print("Schedule unchanged since the last Powerwall update - no update sent.")
+        return 0
+
+    # Fetch the current Powerwall Battery Tariff data from Tesla
+    # The Update API takes the entire tariff configuration structure as input, so fetch
+    # all the current config, and update only the sections we care about - all other
+    # config options in this structure are unchanged
+    try:
+        if powerwall_read is not None:
+            with metrics.stage("tesla_wait"):
+                powerwall, pw_tariff = powerwall_read.result()
+        else:
+            powerwall, pw_tariff = read_powerwall_tariff(metrics)
+    except LookupError as e:
+        _LOGGER.error(e)
+        print(e)
+        return -3
+    metrics.set_value("tesla_tariff_bytes", len(json.dumps(pw_tariff)))
+
+    if VERBOSE:
+        print("Energy Charges")
+        print("==============")
+        print(json.dumps(pw_tariff["energy_charges"]["Summer"], indent=4))
+
+        print("New ToU Rates")
+        print("=============")
+        print(json.dumps(tou_rates, indent=4))
+
+        print("ToU Periods")
+        print("===========")
+        print(json.dumps(pw_tariff["seasons"]["Summer"]["tou_periods"], indent=4))
+
+    # Compare the Powerwall's current tariff with the new one
+    changes = TariffState.diff(TariffState.tariff_section(pw_tariff), new_tariff)
+    metrics.set_value("tariff_changes", len(changes))
+    print(f"Powerwall Tariff Changes: {len(changes)}")
+    for change in changes:
+        print(f"  {change}")
+
+    # Update PW Energy Charges Data section and the ToU Slots in the Battery Tariff data
+    powerwall.update_tariff(pw_tariff, tou_rates, schedule.tou_periods)
+
+    if VERBOSE:
+        print("Energy Charges (Updated)")
+        print("========================")
+        print(json.dumps(pw_tariff["energy_charges"]["Summer"], indent=4))
+
+        print("ToU Periods (Updated)")
+        print("=====================")
+        print(json.dumps(pw_tariff["seasons"]["Summer"]["tou_periods"], indent=4))
+
+    # Don't re-send a tariff the Powerwall already has
+    if not changes:
+        tariff_state.set_digest(state_key, new_digest)
+        print("Powerwall tariff already up to date - no update sent.")
+        return 0
+
+    # Send the changes to the Powerwall API
+    with metrics.stage("tesla_set_tariff"):
+        res = powerwall.set_tariff(pw_tariff)
+    if not res == "Updated":
+        _LOGGER.error("Failed to update Powerwall Battery Tariff data.")
+        return -3
+
+    tariff_state.set_digest(state_key, new_digest)
+    if REPLAY_FILE:
+        print("Replayed the Powerwall Battery Tariff update - nothing was sent to the Powerwall.")
+    else:
+        print("Tesla Powerwall Battery Tariff data successfully updated.")
+    return 0
+
+
+startup_ms = (time.perf_counter() - _START) * 1000
+_LOGGER.info(f"Startup time = {startup_ms:.1f}ms")
+if startup_ms > STARTUP_BUDGET_MS:
+    _LOGGER.warning(f"Startup time {startup_ms:.1f}ms is over the {STARTUP_BUDGET_MS}ms budget")
+
+if DAEMON:
+    # Stay running, and run the pipeline as soon as each day's Agile rates are published
+    daemon = Daemon.Daemon(_LOGGER, agile, TARIFF, AREA_CODE, run_pipeline, STATUS_FILE, PUBLISH_TIME)
+    daemon.run()
+elif chart_server is not None:
+    # Keep serving the chart until interrupted
+    result = run_pipeline()
+    print(f"Serving the chart on {chart_server.url} - press Ctrl+C to stop.")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        chart_server.close()
+    exit(result)
 else:
-    rate_mid_peak = agile.get_average_rate(MidPeak)
-    rate_peak = agile.get_average_rate(Peak)
-
-if VERBOSE:
-    agile.print_tou("Mid-Peak", rate_mid_peak, tou_mid_peak)
-    agile.print_tou("Peak", rate_peak, tou_peak)
-
-# Build the Rate Type / Energy Charges structure 
-#    - this is stored in a separate structure from the ToU time slots
-tou_rates = agile.build_tou_rates(rate_super, rate_off_peak, rate_mid_peak, rate_peak)
-
-# Fetch the current Powerwall Battery Tariff data from Tesla
-# The Update API takes the entire tariff configuration structure as input, so fetch
-# all the current config, and update only the sections we care about - all other
-# config options in this structure are unchanged
-powerwall = Tesla.Powerwall(TESLA_ID)
-pw_tariff = powerwall.get_tariff()
-
-if VERBOSE:
-    print("Energy Charges")
-    print("==============")
-    print(json.dumps(pw_tariff["energy_charges"]["Summer"], indent=4))
-
-    print("New ToU Rates")
-    print("=============")
-    print(json.dumps(tou_rates, indent=4))
-
-# Update PW Energy Charges Data section
-pw_tariff["energy_charges"]["Summer"] = tou_rates
-
-if VERBOSE:
-    print("Energy Charges (Updated)")
-    print("========================")
-    print(json.dumps(pw_tariff["energy_charges"]["Summer"], indent=4))
-
-    print("ToU Periods")
-    print("===========")
-    print(json.dumps(pw_tariff["seasons"]["Summer"]["tou_periods"], indent=4))
-
-# Update ToU Slots in the Battery Tariff data
-pw_tariff["seasons"]["Summer"]["tou_periods"]["SUPER_OFF_PEAK"] = tou_super
-pw_tariff["seasons"]["Summer"]["tou_periods"]["OFF_PEAK"] = tou_off_peak
-pw_tariff["seasons"]["Summer"]["tou_periods"]["PARTIAL_PEAK"] = tou_mid_peak
-pw_tariff["seasons"]["Summer"]["tou_periods"]["ON_PEAK"] = tou_peak
-
-if VERBOSE:
-    print("ToU Periods (Updated)")
-    print("=====================")
-    print(json.dumps(pw_tariff["seasons"]["Summer"]["tou_periods"], indent=4))
-
-if CHART_GEN:
-    if not ChartGen.export_agile_data(agile_time_slots, CHART_PATH):
-        print("Error writing chart time slot data.")
-        exit(-4)
-
-    if not ChartGen.export_agile_rates(agile.MIN, agile.MAX, agile.LIMIT_SUPER_OFF_PEAK, agile.LIMIT_OFF_PEAK,
-                                       agile.LIMIT_MID_PEAK, PEAK_COMBINE, CHART_PATH):
-        print("Error writing chart pw rate data.")
-        exit(-4)
-
-# Don't send the changes to the Powerwall if we are just listing the changes
-if LIST_ONLY:
-    print("List Mode Complete - No Updates Applied.")
-    exit(1)
-
-# Send the changes to the Powerwall API
-res = powerwall.set_tariff(pw_tariff)
-if not res == "Updated":
-    _LOGGER.error("Failed to update Powerwall Battery Tariff data.")
-    exit(-3)
-
-print("Tesla Powerwall Battery Tariff data successfully updated.")
-exit(0)
+    exit(run_pipeline())
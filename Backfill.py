@@ -0,0 +1,39 @@
+import logging
+import argparse
+from datetime import date
+import Octopus
+import OctopusClient
+import RateCache
+
+# Pulls a range of historic Agile rates into the local rate cache, e.g. to backfill a year of history for analysis
+
+_LOGGER = logging.getLogger("AgileWall")
+
+parser = argparse.ArgumentParser(description="Backfill the local Agile rate cache from the Octopus API")
+parser.add_argument("-t", "--tariff", nargs=1, dest="tariff", type=str, required=True,
+                    help="Octopus Agile Tariff code, e.g. AGILE-23-12-06")
+parser.add_argument("-a", "--area", nargs=1, dest="area", type=str, required=True,
+                    help="DNO Area Code - see https://energy-stats.uk/dno-region-codes-explained/")
+parser.add_argument("-f", "--from", dest="start", type=date.fromisoformat, required=True,
+                    help="First Agile day to fetch (YYYY-MM-DD), the Agile day starts at 23:00 on this date")
+parser.add_argument("-u", "--until", dest="end", type=date.fromisoformat, default=date.today(),
+                    help="Agile day to stop at, not included (YYYY-MM-DD) - defaults to today")
+parser.add_argument("-k", "--cache_file", default=RateCache.DEFAULT_CACHE_FILE, dest="cache_file", type=str,
+                    help="Local Agile rate cache file to fill.")
+
+args = parser.parse_args()
+
+with RateCache.RateCache(args.cache_file) as rate_cache:
+    agile = Octopus.Agile(_LOGGER, rate_cache)
+
+    slot_count = 0
+    try:
+        for slot in agile.get_agile_rates_range(args.tariff[0], args.area[0], args.start, args.end):
+            slot_count += 1
+    except OctopusClient.OctopusError as e:
+        # The slots fetched before the failure are kept in the cache, so running again carries on from there
+        print(f"{e} - fetched {slot_count} time slots from {args.start} before the failure")
+        exit(-2)
+
+    print(f"Fetched {slot_count} time slots from {args.start} to {args.end}")
+    print(f"Rate cache = {rate_cache.stats()}")
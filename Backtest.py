@@ -0,0 +1,201 @@
+import os
+import json
+import logging
+import argparse
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import Octopus
+import RateCache
+import Thresholds
+
+# Replays the Agile rate history held in the local rate cache through the banding / merge / average rate pipeline
+# for a set of banding strategies, and reports how each would have performed, e.g.
+#
+#     python Backtest.py -t AGILE-23-12-06 -a C -f 2024-01-01 -u 2025-01-01 -s heuristic -s heuristic+peak
+#
+# Strategies are written as <thresholds>[:<parameters>][+peak]:
+#   heuristic                   the default thresholds
+#   heuristic:0.85,0.9,1.0      the heuristic with different super off-peak, off-peak & mid-peak factors
+#   optimal:40                  the optimal thresholds, with a period penalty of 40
+#   +peak                       combine the Mid-Peak & Peak bands (the -P option)
+# The history is split into chunks of days, which are processed in parallel by a pool of worker processes.
+
+DEFAULT_STRATEGIES = ("heuristic", "heuristic+peak", "optimal", "optimal+peak")
+CHUNKS_PER_WORKER = 4       # Smaller chunks even out the load across the workers
+
+_LOGGER = logging.getLogger("Backtest")
+_LOGGER.addHandler(logging.NullHandler())   # Threshold check failures are counted, not logged
+_LOGGER.propagate = False
+
+
+def parse_strategy(spec):
+    # "optimal:40+peak" -> {"name": ..., "thresholds": "optimal", "period_penalty": 40.0, "peak_combine": True}
+    name = spec
+    peak_combine = spec.endswith("+peak")
+    if peak_combine:
+        spec = spec[:-len("+peak")]
+    thresholds, _, parameters = spec.partition(":")
+    if thresholds not in Thresholds.STRATEGIES:
+        raise ValueError(f"Unknown threshold strategy {thresholds} in {name}")
+
+    strategy = {"name": name, "thresholds": thresholds, "peak_combine": peak_combine,
+                "period_penalty": Thresholds.DEFAULT_PERIOD_PENALTY, "threshold_factors": Thresholds.DEFAULT_FACTORS}
+    if parameters and thresholds == Thresholds.OPTIMAL:
+        strategy["period_penalty"] = float(parameters)
+    elif parameters:
+        factors = tuple(float(factor) for factor in parameters.split(","))
+        if len(factors) != 3:
+            raise ValueError(f"The heuristic takes 3 threshold factors, in {name}")
+        strategy["threshold_factors"] = factors
+    return strategy
+
+
+def new_totals():
+    return {"days": 0, "threshold_failures": 0, "periods": 0, "max_periods": 0, "slots": 0, "squared_error": 0.0,
+            "band_days": {band: 0 for band in Octopus.TOU_BANDS},
+            "band_spread": {band: 0.0 for band in Octopus.TOU_BANDS},
+            "band_rate": {band: 0.0 for band in Octopus.TOU_BANDS}}
+
+
+def backtest_days(strategies, days):
+    # Worker: run each Agile day (a list of (valid_from, valid_to, price_exc, price_inc) rows) through each
+    # strategy, and return the totals for each strategy
+    results = {}
+    for strategy in strategies:
+        agile = Octopus.Agile(_LOGGER, thresholds=strategy["thresholds"], period_penalty=strategy["period_penalty"],
+                              threshold_factors=strategy["threshold_factors"])
+        totals = new_totals()
+
+        for rows in days:
+            schedule = Octopus.RateSchedule.from_rows(rows)
+            totals["days"] += 1
+            if not agile.set_rate_limits(schedule):
+                totals["threshold_failures"] += 1
+                continue
+
+            tariff = agile.build_schedule(schedule, strategy["peak_combine"])
+            periods = sum(len(tariff.tou_periods[band]) for band in Octopus.TOU_BANDS)
+            totals["periods"] += periods
+            totals["max_periods"] = max(totals["max_periods"], periods)
+
+            for band in Octopus.TOU_BANDS:
+                prices = tariff.slots[band].values("price_inc")
+                if not prices:
+                    continue
+                # How far the band's single (Powerwall) rate is from the Agile price of each of its slots
+                rate = tariff.rates[band]
+                totals["slots"] += len(prices)
+                totals["squared_error"] += sum((price - rate) ** 2 for price in prices)
+                totals["band_days"][band] += 1
+                totals["band_spread"][band] += max(prices) - min(prices)
+                totals["band_rate"][band] += rate
+
+        results[strategy["name"]] = totals
+    return results
+
+
+def add_totals(totals, other):
+    for key in ("days", "threshold_failures", "periods", "slots", "squared_error"):
+        totals[key] += other[key]
+    totals["max_periods"] = max(totals["max_periods"], other["max_periods"])
+    for key in ("band_days", "band_spread", "band_rate"):
+        for band in Octopus.TOU_BANDS:
+            totals[key][band] += other[key][band]
+
+
+def summarise(totals):
+    scored_days = totals["days"] - totals["threshold_failures"]
+    return {"days": totals["days"],
+            "threshold_failures": totals["threshold_failures"],
+            "mean_periods": round(totals["periods"] / scored_days, 2) if scored_days else None,
+            "max_periods": totals["max_periods"],
+            "rms_rate_error": round((totals["squared_error"] / totals["slots"]) ** 0.5, 3) if totals["slots"] else None,
+            "bands": {band: {"days": totals["band_days"][band],
+                             "mean_spread": round(totals["band_spread"][band] / totals["band_days"][band], 3),
+                             "mean_rate": round(totals["band_rate"][band] / totals["band_days"][band], 3)}
+                      for band in Octopus.TOU_BANDS if totals["band_days"][band]}}
+
+
+def load_days(rate_cache, tariff_code, area_code, start_day, end_day):
+    # The complete Agile days held in the cache - incomplete days are skipped
+    days = []
+    skipped = 0
+    day = start_day
+    while day < end_day:
+        period_from, period_to = RateCache.period_bounds(day)
+        rows, missing = rate_cache.get_rates(tariff_code, area_code, period_from, period_to)
+        if missing:
+            skipped += 1
+        else:
+            days.append(rows)
+        day += timedelta(days=1)
+    return days, skipped
+
+
+def run_backtest(strategies, days, workers):
+    chunk_size = max(1, -(-len(days) // (workers * CHUNKS_PER_WORKER)))
+    chunks = [days[start:start + chunk_size] for start in range(0, len(days), chunk_size)]
+
+    totals = {strategy["name"]: new_totals() for strategy in strategies}
+    with ProcessPoolExecutor(workers) as pool:
+        for results in pool.map(backtest_days, [strategies] * len(chunks), chunks):
+            for name, result in results.items():
+                add_totals(totals[name], result)
+
+    return {name: summarise(result) for name, result in totals.items()}
+
+
+def print_report(report):
+    print(f"{'Strategy':<24} {'Days':>5} {'Fails':>5} {'Periods':>8} {'Max':>4} {'RMS Err':>8}  "
+          + "  ".join(f"{band:>16}" for band in Octopus.TOU_BANDS))
+    for name, summary in report.items():
+        bands = "  ".join(f"{summary['bands'][band]['mean_rate']:>7.2f}p "
+                          f"±{summary['bands'][band]['mean_spread']:>6.2f}"
+                          if band in summary["bands"] else f"{'-':>16}" for band in Octopus.TOU_BANDS)
+        print(f"{name:<24} {summary['days']:>5} {summary['threshold_failures']:>5} "
+              f"{summary['mean_periods'] if summary['mean_periods'] is not None else '-':>8} "
+              f"{summary['max_periods']:>4} "
+              f"{summary['rms_rate_error'] if summary['rms_rate_error'] is not None else '-':>8}  {bands}")
+    print("Band columns: mean band rate ± mean price spread (max - min) of the band's slots each day")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest AgileWall banding strategies over the cached rate history")
+    parser.add_argument("-t", "--tariff", nargs=1, dest="tariff", type=str, required=True,
+                        help="Octopus Agile Tariff code, e.g. AGILE-23-12-06")
+    parser.add_argument("-a", "--area", nargs=1, dest="area", type=str, required=True,
+                        help="DNO Area Code - see https://energy-stats.uk/dno-region-codes-explained/")
+    parser.add_argument("-f", "--from", dest="start", type=date.fromisoformat,
+                        default=date.today() - timedelta(days=365),
+                        help="First Agile day to replay (YYYY-MM-DD) - defaults to a year ago")
+    parser.add_argument("-u", "--until", dest="end", type=date.fromisoformat, default=date.today(),
+                        help="Agile day to stop at, not included (YYYY-MM-DD) - defaults to today")
+    parser.add_argument("-s", "--strategy", action="append", dest="strategies", type=str,
+                        help=f"Strategy to backtest, may be repeated (default {', '.join(DEFAULT_STRATEGIES)})")
+    parser.add_argument("-w", "--workers", default=os.cpu_count(), dest="workers", type=int,
+                        help="Worker processes (default one per CPU)")
+    parser.add_argument("-k", "--cache_file", default=RateCache.DEFAULT_CACHE_FILE, dest="cache_file", type=str,
+                        help="Local Agile rate cache holding the history - see Backfill.py")
+    parser.add_argument("-o", "--output", default=None, dest="output", type=str,
+                        help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    try:
+        backtest_strategies = [parse_strategy(spec) for spec in args.strategies or DEFAULT_STRATEGIES]
+    except ValueError as e:
+        parser.error(str(e))
+
+    with RateCache.RateCache(args.cache_file) as cache:
+        history, skipped_days = load_days(cache, args.tariff[0], args.area[0], args.start, args.end)
+    print(f"Replaying {len(history)} Agile days from {args.start} to {args.end} "
+          f"({skipped_days} incomplete days skipped)")
+    if not history:
+        print("No complete Agile days found in the rate cache - use Backfill.py to fetch the history.")
+        exit(-2)
+
+    backtest_report = run_backtest(backtest_strategies, history, args.workers)
+    print_report(backtest_report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(backtest_report, f, indent=4)
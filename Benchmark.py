@@ -0,0 +1,211 @@
+import io
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+from datetime import date, datetime
+from urllib.parse import urlparse, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import Octopus
+import Tesla
+import ChartGen
+import LocalTime
+import RateCache
+import RateArrays
+import TariffState
+import SyntheticRates
+
+# Benchmarks each stage of the AgileWall pipeline over synthetic Agile rates, plus an end to end run against a
+# local stand-in for the Octopus API and a fake Tesla battery. Results are written as JSON, e.g.
+#
+#     python Benchmark.py -n 1,30,365 -r 5 -o bench.json
+
+_LOGGER = logging.getLogger("AgileWall")
+
+DEFAULT_DAYS = "1,30,365"
+DEFAULT_REPEAT = 5
+BENCH_START_DAY = date(2024, 1, 1)
+
+
+class OctopusStub:
+    # Local HTTP stand-in for the Octopus standard-unit-rates endpoint, serving paginated synthetic rates
+
+    def __init__(self, seed=0):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                body = json.dumps(stub.page(self.path)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.seed = seed
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def page(self, path):
+        url = urlparse(path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        results = SyntheticRates.octopus_results(LocalTime.to_epoch(query["period_from"]),
+                                                 LocalTime.to_epoch(query["period_to"]), self.seed)
+
+        page_size = int(query.get("page_size", 100))
+        page = int(query.get("page", 1))
+        next_url = None
+        if page * page_size < len(results):
+            next_url = f"{self.url}{url.path[3:]}?{urlencode(dict(query, page=page + 1))}"
+        return {"count": len(results), "next": next_url, "previous": None,
+                "results": results[(page - 1) * page_size:page * page_size]}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeBattery(dict):
+    # Stands in for a teslapy Battery - keeps the tariff in memory
+
+    def __init__(self):
+        super().__init__(id="bench", energy_site_id=0, site_name="Benchmark")
+        bands = {band: [] for band in Octopus.TOU_BANDS}
+        self.tariff = {"energy_charges": {"ALL": {"ALL": 0}, "Summer": {band: 0 for band in Octopus.TOU_BANDS}},
+                       "seasons": {"Summer": {"fromDay": 1, "toDay": 31, "fromMonth": 1, "toMonth": 12,
+                                              "tou_periods": bands}}}
+
+    def get_tariff(self):
+        return json.loads(json.dumps(self.tariff))
+
+    def set_tariff(self, tariff):
+        self.tariff = json.loads(json.dumps(tariff))
+        return "Updated"
+
+
+class FakeTesla:
+    # Stands in for a teslapy.Tesla session
+    authorized = True
+
+    def __init__(self):
+        self.battery = FakeBattery()
+
+    def battery_list(self):
+        return [self.battery]
+
+    def close(self):
+        pass
+
+
+def time_stage(stage, slot_count, func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    result = {"stage": stage, "slots": slot_count, "repeat": repeat,
+              "best_ms": round(min(timings), 3), "mean_ms": round(sum(timings) / len(timings), 3)}
+    print(f"{stage:<24} {slot_count:>8} slots  best {result['best_ms']:>10.3f}ms  mean {result['mean_ms']:>10.3f}ms",
+          file=sys.stderr)
+    return result
+
+
+def bench_stages(days, repeat, seed, out_dir):
+    schedule = SyntheticRates.synthetic_schedule(BENCH_START_DAY, days, seed)
+    slot_count = len(schedule)
+    agile = Octopus.Agile(_LOGGER)
+
+    results = [time_stage("set_rate_limits", slot_count, lambda: agile.set_rate_limits(schedule), repeat)]
+
+    bands = agile.classify_slots(schedule)
+    results.append(time_stage("classify_slots", slot_count, lambda: agile.classify_slots(schedule), repeat))
+    results.append(time_stage("classify_slots_combined", slot_count,
+                              lambda: agile.classify_slots(schedule, True), repeat))
+
+    merged = [agile.merge_adjacent_slots(band) for band in bands]
+    results.append(time_stage("merge_adjacent_slots", slot_count,
+                              lambda: [agile.merge_adjacent_slots(band) for band in bands], repeat))
+
+    merged_count = sum(len(band) for band in merged)
+    results.append(time_stage("build_tou_periods", merged_count,
+                              lambda: [agile.build_tou_periods(band) for band in merged], repeat))
+
+    rates = [agile.get_average_rate(band) if len(band) else 0 for band in merged]
+    results.append(time_stage("build_tou_rates", merged_count, lambda: agile.build_tou_rates(*rates), repeat))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results.append(time_stage("export_agile_data", slot_count,
+                                  lambda: ChartGen.export_agile_data(schedule, out_dir), repeat))
+    return results
+
+
+def bench_end_to_end(repeat, seed, out_dir):
+    # Fetch from the Octopus stand-in, build the schedule, write the charts and update the fake Powerwall
+    stub = OctopusStub(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        powerwall = Tesla.Powerwall("bench", tesla=FakeTesla())
+    results = []
+
+    def run(rate_cache=None):
+        agile = Octopus.Agile(_LOGGER, rate_cache, api_url=stub.url)
+        agile_time_slots = agile.get_agile_rates("AGILE-BENCH", "X", 0)
+        schedule = agile.build_schedule(agile_time_slots)
+        ChartGen.export_agile_data(agile_time_slots, out_dir)
+        ChartGen.export_agile_rates(agile.MIN, agile.MAX, agile.LIMIT_SUPER_OFF_PEAK, agile.LIMIT_OFF_PEAK,
+                                    agile.LIMIT_MID_PEAK, False, out_dir)
+        pw_tariff = powerwall.get_tariff()
+        new_tariff = TariffState.normalise(schedule.tou_rates, schedule.tou_periods)
+        if TariffState.diff(TariffState.tariff_section(pw_tariff), new_tariff):
+            powerwall.set_tariff(powerwall.update_tariff(pw_tariff, schedule.tou_rates, schedule.tou_periods))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results.append(time_stage("end_to_end", 48, run, repeat))
+        with RateCache.RateCache(f"{out_dir}/bench_cache.db") as rate_cache:
+            results.append(time_stage("end_to_end_cached", 48, lambda: run(rate_cache), repeat))
+
+    stub.close()
+    return results, stub.requests
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AgileWall pipeline benchmarks")
+    parser.add_argument("-n", "--days", default=DEFAULT_DAYS, dest="days", type=str,
+                        help=f"Comma separated series lengths in days (default {DEFAULT_DAYS})")
+    parser.add_argument("-r", "--repeat", default=DEFAULT_REPEAT, dest="repeat", type=int,
+                        help=f"Timed runs of each stage (default {DEFAULT_REPEAT})")
+    parser.add_argument("-s", "--seed", default=0, dest="seed", type=int, help="Synthetic price seed")
+    parser.add_argument("-o", "--output", default=None, dest="output", type=str,
+                        help="Write the JSON results to this file (default stdout)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        stage_results = []
+        for day_count in [int(days) for days in args.days.split(",")]:
+            stage_results += bench_stages(day_count, args.repeat, args.seed, temp_dir)
+        e2e_results, stub_requests = bench_end_to_end(args.repeat, args.seed, temp_dir)
+
+    report = {"timestamp": datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "backend": RateArrays.backend(),
+              "seed": args.seed,
+              "results": stage_results + e2e_results,
+              "octopus_stub_requests": stub_requests}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
@@ -1,43 +1,27 @@
 import os
-from dateutil import parser, tz
+import json
+from bisect import bisect_right
+from datetime import datetime, timezone
+import Files
+import LocalTime
+import Octopus
+import RateCache
+import Thresholds
 
 LOCAL_TZ = 'Europe/London'
-
-
-def to_local_time(time_utc, dest_tz):
-    dest_zone = tz.gettz(dest_tz)
-    utc = parser.parse(time_utc)  # Parse Agile UTC Time String
-    local_time = utc.astimezone(dest_zone)
-
-    return local_time
+CHART_JSON_FILE = "agile_chart.json"
+HISTORY_DIR = "agile_history"
+HISTORY_LEVELS = (7, 30, 90, 365)   # Days covered by each precomputed history level (plus the whole history)
+POINT_BUDGET = 480                  # Most price points in a history level - 10 days at full resolution
 
 
 def export_agile_data(rateslots, out_dir):
-    # Sort slots into time order for the chart
-    rateslots.sort(key=lambda x: x.valid_from)
-
-    # Write JSON file
-    # Write pw rates to file
+    # Write the rates for the chart, in time order
     file_name = os.path.join(out_dir, "agile_data.js")
 
     print(f"Agile Chart Data = {file_name}")
 
-    with open(file_name, 'w') as f:
-        last = 0
-        f.write(f"// Octopus Agile Daily Data\n" f"var RATES = [")
-        for rate in rateslots:
-            f.write(f'"{rate.price_inc}", ')
-            last = rate.price_inc
-
-        f.write(f'"{last}"]\n')
-        f.write(f"var TIMES = [")
-
-        for rate in rateslots:
-            # Correct chart time for local time zone
-            from_t = to_local_time(rate.valid_from, LOCAL_TZ)
-            f.write(f'"{from_t.hour:02}:{from_t.minute:02}", ')
-
-        f.write(f'""]\n')
+    Files.atomic_write(file_name, agile_data_text(rateslots))
 
     return True
 
@@ -48,14 +32,219 @@ def export_agile_rates(rate_min, rate_max, off_peak, mid_peak, peak, peak_combin
 
     print(f"Powerwall Rate Data = {file_name}")
 
-    with open(file_name, 'w') as f:
-        f.write(f"// Powerwall Rate Ranges\n"
-                f"var MIN = {round(rate_min, 1)}\n"
-                f"var OFF_PEAK = {round(off_peak, 1)}\n"
-                f"var MID_PEAK = {round(mid_peak, 1)}\n"
-                f"var PEAK = {round(peak, 1)}\n"
-                f"var MAX = {round(rate_max, 1)}\n"
-                f"var COMBINE = {int(peak_combine)}\n"
-                )
+    Files.atomic_write(file_name, powerwall_rates_text(rate_min, rate_max, off_peak, mid_peak, peak, peak_combine))
 
     return True
+
+
+def export_chart_json(rateslots, rate_min, rate_max, off_peak, mid_peak, peak, peak_combine, out_dir,
+                      history_days=0):
+    # Write everything the chart needs into a single compact JSON file, so the page loads one small file
+    # instead of the agile_data.js & powerwall_rates.js script includes
+    file_name = os.path.join(out_dir, CHART_JSON_FILE)
+
+    print(f"Chart JSON Data = {file_name}")
+
+    levels = {}
+    if history_days > 0:
+        history = export_agile_history(rateslots, out_dir, history_days, (off_peak, mid_peak, peak))
+        levels = export_history_levels(history, out_dir, history_days)
+    Files.atomic_write(file_name, chart_json_text(rateslots, rate_min, rate_max, off_peak, mid_peak, peak,
+                                                  peak_combine, levels))
+
+    return True
+
+
+def remove_chart_json(out_dir):
+    # The page prefers agile_chart.json to the script files, so one left by an earlier run would hide the new data
+    file_name = os.path.join(out_dir, CHART_JSON_FILE)
+    if os.path.exists(file_name):
+        os.remove(file_name)
+
+
+def agile_data_text(rateslots):
+    prices, times = _chart_series(rateslots)
+
+    # The last price is repeated so the final step of the stepline chart is drawn
+    last = prices[-1] if prices else 0
+    rates = "".join(f'"{price}", ' for price in prices)
+    labels = "".join(f'"{time_label}", ' for time_label in times)
+    return (f"// Octopus Agile Daily Data\n"
+            f"var RATES = [{rates}\"{last}\"]\n"
+            f"var TIMES = [{labels}\"\"]\n")
+
+
+def powerwall_rates_text(rate_min, rate_max, off_peak, mid_peak, peak, peak_combine):
+    limits = _rate_limits(rate_min, rate_max, off_peak, mid_peak, peak, peak_combine)
+    return "// Powerwall Rate Ranges\n" + "".join(f"var {name} = {value}\n" for name, value in limits.items())
+
+
+def chart_json_text(rateslots, rate_min, rate_max, off_peak, mid_peak, peak, peak_combine, levels=None):
+    # levels: the history level file for each number of days (see export_history_levels), so the page can load
+    # the one which fits the range it shows
+    prices, times = _chart_series(rateslots)
+    limits = _rate_limits(rate_min, rate_max, off_peak, mid_peak, peak, peak_combine)
+    return json.dumps({"rates": prices, "times": times, "limits": limits, "levels": levels or {}},
+                      separators=(",", ":"))
+
+
+def export_agile_history(rateslots, out_dir, days, limits=None):
+    # Rolling history: each complete Agile day is written once to its own file in the history directory,
+    # and days more than `days` before the latest are deleted. Published Agile prices never change, so files
+    # for days already stored are not rewritten. limits are the (super off-peak, off-peak, mid-peak) band
+    # thresholds the day's rates were banded with, kept for the history levels' band summaries.
+    # Returns the JSON for each day held, oldest first.
+    schedule = Octopus.RateSchedule.of(rateslots).sorted_by_time()
+    history_dir = os.path.join(out_dir, HISTORY_DIR)
+    os.makedirs(history_dir, exist_ok=True)
+
+    day_rates = {}
+    for valid_from, price in zip(schedule.values("valid_from"), schedule.values("price_inc")):
+        day_rates.setdefault(RateCache.agile_day_bounds(valid_from), []).append(price)
+
+    for (day_from, day_to), prices in day_rates.items():
+        file_name = os.path.join(history_dir, _history_file_name(day_from))
+        # Only complete days (46 or 50 slots over a clock change) are stored - a partial day is written once the
+        # rest of its slots are available
+        if len(prices) == RateCache.period_slots(day_from, day_to) and not os.path.exists(file_name):
+            day = {"from": day_from, "rates": prices}
+            if limits is not None:
+                day["limits"] = [round(limit, 3) for limit in limits]
+            Files.atomic_write(file_name, json.dumps(day, separators=(",", ":")))
+
+    stored = sorted(name for name in os.listdir(history_dir) if name.startswith("agile_") and name.endswith(".json"))
+    if not stored:
+        return []
+
+    # Drop the days which have rolled out of the history window
+    latest = datetime.strptime(stored[-1], "agile_%Y-%m-%d.json").replace(tzinfo=timezone.utc)
+    oldest = _history_file_name(int(latest.timestamp()) + RateCache.AGILE_DAY_START
+                                - (days - 1) * LocalTime.DAY_SECONDS)
+    history = []
+    for name in stored:
+        if name < oldest:
+            os.remove(os.path.join(history_dir, name))
+        else:
+            with open(os.path.join(history_dir, name)) as f:
+                history.append(f.read())
+
+    return history
+
+
+def history_levels(history, days):
+    # Precomputed views of the history (the JSON of each day, oldest first) for the chart to load by range: for
+    # each of HISTORY_LEVELS shorter than the history, plus the whole history, the latest days' prices reduced to
+    # at most POINT_BUDGET points (keeping the shape of the price curve), and the min / average / max price in
+    # each band for each day. Returns [(days, file name, JSON), ...]
+    level_days = [level for level in HISTORY_LEVELS if level < min(days, len(history))] + [days]
+    history_days = [json.loads(day) for day in history]
+
+    levels = []
+    for level in level_days:
+        level_history = history_days[-level:]
+        times = [day["from"] + slot * RateCache.SLOT_SECONDS
+                 for day in level_history for slot in range(len(day["rates"]))]
+        prices = [price for day in level_history for price in day["rates"]]
+        keep = _downsample(times, prices, POINT_BUDGET)
+
+        bands = {"from": [day["from"] for day in level_history]}
+        bands.update({band: [] for band in Octopus.TOU_BANDS})
+        for day in level_history:
+            for band, summary in zip(Octopus.TOU_BANDS, _band_summary(day)):
+                bands[band].append(summary)
+
+        text = json.dumps({"days": level, "times": [times[index] for index in keep],
+                           "rates": [prices[index] for index in keep], "bands": bands}, separators=(",", ":"))
+        levels.append((level, _level_file_name(level), text))
+    return levels
+
+
+def export_history_levels(history, out_dir, days):
+    # Write the history levels (see history_levels) alongside the chart data, and delete any levels left from a
+    # longer history. Returns the level file for each number of days.
+    levels = history_levels(history, days) if history else []
+    for _, name, text in levels:
+        Files.atomic_write(os.path.join(out_dir, name), text)
+
+    level_files = {level: name for level, name, _ in levels}
+    current = set(level_files.values())
+    for name in os.listdir(out_dir or "."):
+        if name.startswith("agile_history_") and name.endswith("d.json") and name not in current:
+            os.remove(os.path.join(out_dir, name))
+    return level_files
+
+
+def _downsample(times, values, budget):
+    # Largest-Triangle-Three-Buckets: the indexes of at most `budget` points which keep the visual shape of the
+    # series - the first & last points, plus the point in each bucket making the largest triangle with the
+    # point kept from the previous bucket and the average of the next bucket
+    count = len(values)
+    if count <= budget or budget < 3:
+        return range(count)
+
+    keep = [0]
+    bucket_size = (count - 2) / (budget - 2)
+    previous = 0
+    for bucket in range(budget - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        next_end = min(int((bucket + 2) * bucket_size) + 1, count)
+        next_time = sum(times[end:next_end]) / (next_end - end)
+        next_value = sum(values[end:next_end]) / (next_end - end)
+
+        best = start
+        best_area = -1.0
+        for index in range(start, end):
+            area = abs((times[previous] - next_time) * (values[index] - values[previous]) -
+                       (times[previous] - times[index]) * (next_value - values[previous]))
+            if area > best_area:
+                best = index
+                best_area = area
+        keep.append(best)
+        previous = best
+    keep.append(count - 1)
+    return keep
+
+
+def _band_summary(day):
+    # [min, average, max] of the day's prices in each band (None if the band is empty), banded with the day's
+    # stored thresholds - or the default thresholds for days stored without them
+    prices = day["rates"]
+    limits = day.get("limits") or Thresholds.heuristic_limits(min(prices), sum(prices) / len(prices), max(prices))
+    bands = [[] for _ in Octopus.TOU_BANDS]
+    for price in prices:
+        bands[bisect_right(limits, price)].append(price)
+    return [[min(band), round(sum(band) / len(band), 3), max(band)] if band else None for band in bands]
+
+
+def _level_file_name(days):
+    return f"agile_history_{days}d.json"
+
+
+def _chart_series(rateslots):
+    # Sort slots into time order for the chart, with each slot's local start time as its label
+    schedule = Octopus.RateSchedule.of(rateslots).sorted_by_time()
+    clock = LocalTime.get_clock(LOCAL_TZ)
+
+    times = []
+    for valid_from in schedule.values("valid_from"):
+        # Correct chart time for local time zone
+        from_hour, from_minute = clock.hour_minute(valid_from)
+        times.append(f"{from_hour:02}:{from_minute:02}")
+
+    return list(schedule.values("price_inc")), times
+
+
+def _rate_limits(rate_min, rate_max, off_peak, mid_peak, peak, peak_combine):
+    return {"MIN": round(rate_min, 1),
+            "OFF_PEAK": round(off_peak, 1),
+            "MID_PEAK": round(mid_peak, 1),
+            "PEAK": round(peak, 1),
+            "MAX": round(rate_max, 1),
+            "COMBINE": int(peak_combine)}
+
+
+def _history_file_name(day_from):
+    # Named after the UTC date the Agile day starts on (at 23:00)
+    return datetime.fromtimestamp(day_from, timezone.utc).strftime("agile_%Y-%m-%d.json")
+
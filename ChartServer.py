@@ -0,0 +1,144 @@
+import os
+import time
+import hashlib
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Embedded chart server: serves agile_chart.html, chart_options.js and the chart data from memory, with
+# ETag / Last-Modified validators so unchanged files are answered with 304 Not Modified. Connected pages are
+# told about each new schedule through a Server-Sent Events stream (/events), so they redraw only when the
+# data changes instead of reloading the whole page on a timer.
+
+DEFAULT_HOST = "0.0.0.0"
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_FILES = ("agile_chart.html", "chart_options.js")
+KEEPALIVE_SECONDS = 30      # Comment lines keep idle event streams (and any proxies in between) open
+
+CONTENT_TYPES = {".html": "text/html; charset=utf-8",
+                 ".js": "text/javascript; charset=utf-8",
+                 ".json": "application/json"}
+
+
+class ChartServer:
+
+    def __init__(self, logger, port, host=DEFAULT_HOST, static_dir=STATIC_DIR):
+        self._LOGGER = logger
+        self.files = {}             # name -> (body, ETag, Last-Modified epoch, content type)
+        self.version = 0            # Bumped each time new chart data is published
+        self.closed = False
+        self.changed = threading.Condition()
+
+        for name in STATIC_FILES:
+            with open(os.path.join(static_dir, name), "rb") as f:
+                self.__put(name, f.read(), os.path.getmtime(f.name))
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0].lstrip("/") or STATIC_FILES[0]
+                if path == "events":
+                    server.stream_events(self)
+                else:
+                    server.send_file(self, path)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_port}/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self._LOGGER.info(f"Chart server listening on {self.url}")
+
+    def publish(self, files):
+        # Replace the chart data files (name -> text) and notify the connected pages if any have changed
+        modified = time.time()
+        with self.changed:
+            changed = [self.__put(name, text.encode(), modified) for name, text in files.items()]
+            if any(changed):
+                self.version += 1
+                self.changed.notify_all()
+
+    def __put(self, name, body, modified):
+        content_type = CONTENT_TYPES.get(os.path.splitext(name)[1], "application/octet-stream")
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        current = self.files.get(name)
+        if current is not None and current[1] == etag:
+            return False    # Unchanged - keep the original Last-Modified time
+        self.files[name] = (body, etag, int(modified), content_type)
+        return True
+
+    def send_file(self, request, path):
+        file = self.files.get(path)
+        if file is None:
+            request.send_error(404)
+            return
+
+        body, etag, modified, content_type = file
+        if self.__not_modified(request, etag, modified):
+            request.send_response(304)
+            request.send_header("ETag", etag)
+            request.end_headers()
+            return
+
+        request.send_response(200)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(body)))
+        request.send_header("ETag", etag)
+        request.send_header("Last-Modified", formatdate(modified, usegmt=True))
+        # Browsers may cache, but must revalidate - which costs a 304 when nothing has changed
+        request.send_header("Cache-Control", "no-cache")
+        request.end_headers()
+        request.wfile.write(body)
+
+    @staticmethod
+    def __not_modified(request, etag, modified):
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            # If-None-Match takes precedence over If-Modified-Since
+            return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+
+        if_modified_since = request.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                return modified <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def stream_events(self, request):
+        # Server-Sent Events: an "update" event is sent each time new chart data is published
+        request.send_response(200)
+        request.send_header("Content-Type", "text/event-stream")
+        request.send_header("Cache-Control", "no-cache")
+        request.end_headers()
+
+        version = self.version
+        try:
+            while True:
+                with self.changed:
+                    self.changed.wait_for(lambda: self.version != version or self.closed, KEEPALIVE_SECONDS)
+                    if self.closed:
+                        return
+                    updated = self.version != version
+                    version = self.version
+
+                request.wfile.write(f"event: update\ndata: {version}\n\n".encode() if updated else b": keepalive\n\n")
+                request.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass    # Page closed
+
+    def close(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
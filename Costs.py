@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import logging
+import argparse
+from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+import Octopus
+import RateCache
+import Backtest
+
+# Works out what the bands AgileWall sends to the Powerwall actually cost, against a meter's real consumption.
+# Half-hourly consumption is streamed from the Octopus API into the local rate store, then each complete Agile
+# day of consumption is joined to the Agile price of each slot and to the band the slot was put in, giving the
+# day's cost in each band at the Agile prices, and at the band's single (Powerwall) rate. The difference is the
+# error introduced by averaging the prices in each band. e.g.
+#
+#     python Costs.py -t AGILE-23-12-06 -a C -m 1200012345678 -n 21L1234567 -K sk_live_... -f 2024-01-01
+#
+# Only new consumption is fetched, and only the days which haven't been costed yet are worked out, one day at a
+# time - so it can be run daily over years of history. Use -c to run it for every site in a fleet config file
+# which has meter details, e.g. {"name": "Home", "tariff": ..., "area": ..., "mpan": ..., "meter_serial": ...,
+# "api_key": ..., "strategy": "optimal+peak"} (see Fleet.py).
+
+_LOGGER = logging.getLogger("AgileWall")
+
+UNBANDED = "UNBANDED"       # Days whose rates couldn't be banded - costed at the Agile prices only
+DEFAULT_WORKERS = 4
+
+
+def day_date(day):
+    # The date an Agile day is named by (its 23:00 start) - see RateCache.period_bounds()
+    return datetime.fromtimestamp(day, timezone.utc).date()
+
+
+class CostEngine:
+    # Costs one meter's consumption for one tariff / area / banding strategy (see Backtest.parse_strategy)
+
+    def __init__(self, logger, cache, mpan, serial, tariff_code, area_code, strategy):
+        self._LOGGER = logger
+        self.cache = cache
+        self.mpan = mpan
+        self.serial = serial
+        self.tariff_code = tariff_code
+        self.area_code = area_code
+        self.strategy = strategy
+        self.key = (mpan, serial, tariff_code, area_code, strategy["name"])
+        self.agile = Octopus.Agile(logger, cache, thresholds=strategy["thresholds"],
+                                   period_penalty=strategy["period_penalty"],
+                                   threshold_factors=strategy["threshold_factors"])
+
+    def update(self):
+        # Cost each complete Agile day of stored consumption which hasn't been costed yet - returns the number
+        # of days costed
+        first, last = self.cache.consumption_bounds(self.mpan, self.serial)
+        if first is None:
+            return 0
+        done = self.cache.last_costed_day(self.key)
+        start = RateCache.agile_day_bounds(done)[1] if done is not None else RateCache.agile_day_start(first)
+        # The last day isn't complete until the first interval of the next day
+        end = RateCache.agile_day_start(last)
+        if start >= end:
+            return 0
+
+        # Fill in any rates the store doesn't hold yet (cached windows aren't fetched again) - if they can't be
+        # fetched the OctopusError stops the update, rather than costing up to a gap in the rates
+        for _ in self.agile.get_agile_rates_range(self.tariff_code, self.area_code, day_date(start), day_date(end)):
+            pass
+
+        day_count = 0
+        day = start
+        while day < end:
+            # Agile days run 23:00 -> 23:00 local time, so are 23 or 25 hours long over a clock change
+            day_end = RateCache.agile_day_bounds(day)[1]
+            rows, missing = self.cache.get_rates(self.tariff_code, self.area_code, day, day_end)
+            if missing:
+                # Stop here, so the day is costed by a later run once its rates are available
+                self._LOGGER.warning(f"CostEngine.update() - {len(missing)} Agile rates missing for {day_date(day)}, "
+                                     f"stopping")
+                break
+            self.cache.put_costs(self.key, day, self.cost_day(rows, day, day_end))
+            day_count += 1
+            day = day_end
+        return day_count
+
+    def cost_day(self, rows, day, day_end):
+        # [(band, slots, kWh, cost, band cost), ...] for one Agile day's rates & consumption (costs in pence)
+        usage = {start: kwh for start, _, kwh in self.cache.get_consumption(self.mpan, self.serial, day, day_end)}
+        schedule = Octopus.RateSchedule.from_rows(rows)
+
+        if not self.agile.set_rate_limits(schedule):
+            bands = {UNBANDED: (schedule, None)}
+        else:
+            tariff = self.agile.build_schedule(schedule, self.strategy["peak_combine"])
+            bands = {band: (tariff.slots[band], tariff.rates[band]) for band in Octopus.TOU_BANDS}
+
+        costs = []
+        for band, (slots, rate) in bands.items():
+            slot_count = 0
+            kwh_total = cost = band_cost = 0.0
+            for valid_from, price in zip(slots.values("valid_from"), slots.values("price_inc")):
+                kwh = usage.get(valid_from)
+                if kwh is None:
+                    continue
+                slot_count += 1
+                kwh_total += kwh
+                cost += kwh * price
+                band_cost += kwh * (price if rate is None else rate)
+            if slot_count:
+                costs.append((band, slot_count, kwh_total, cost, band_cost))
+        return costs
+
+    def report(self, start_day, end_day, by_day=False):
+        # Cost totals for the Agile days from start_day up to (not including) end_day
+        period_from, _ = RateCache.period_bounds(start_day)
+        period_to, _ = RateCache.period_bounds(end_day)
+        report = {"bands": {}, "days": {}, "total": new_totals()}
+        for _, band, slot_count, kwh, cost, band_cost in self.cache.get_costs(self.key, period_from, period_to):
+            report["bands"][band] = new_totals()
+            for totals in (report["bands"][band], report["total"]):
+                add_costs(totals, slot_count, kwh, cost, band_cost)
+        if by_day:
+            for day, _, slot_count, kwh, cost, band_cost in self.cache.get_costs(self.key, period_from, period_to,
+                                                                                True):
+                add_costs(report["days"].setdefault(str(day_date(day)), new_totals()), slot_count, kwh, cost,
+                          band_cost)
+
+        for totals in [report["total"], *report["bands"].values(), *report["days"].values()]:
+            finish_totals(totals)
+        return report
+
+
+def new_totals():
+    return {"slots": 0, "kwh": 0.0, "cost": 0.0, "band_cost": 0.0}
+
+
+def add_costs(totals, slot_count, kwh, cost, band_cost):
+    totals["slots"] += slot_count
+    totals["kwh"] += kwh
+    totals["cost"] += cost
+    totals["band_cost"] += band_cost
+
+
+def finish_totals(totals):
+    # Round to 0.01p & 0.001kWh, and add the averaging error
+    totals["kwh"] = round(totals["kwh"], 3)
+    totals["cost"] = round(totals["cost"], 2)
+    totals["band_cost"] = round(totals["band_cost"], 2)
+    totals["error"] = round(totals["band_cost"] - totals["cost"], 2)
+    totals["error_pct"] = round(100 * totals["error"] / totals["cost"], 2) if totals["cost"] else None
+
+
+def run_site(site, cache, start_day, end_day, offline=False, by_day=False):
+    # Ingest a site's new consumption and cost its new days - returns (site name, report or None, error)
+    name = site.get("name", site["mpan"])
+    try:
+        strategy = Backtest.parse_strategy(site.get("strategy") or ("heuristic+peak" if site.get("peak")
+                                                                    else "heuristic"))
+        if not offline:
+            period_from, _ = RateCache.period_bounds(start_day)
+            consumption = Octopus.Consumption(_LOGGER, site["api_key"], site["mpan"], site["meter_serial"], cache)
+            if consumption.ingest(period_from) < 0:
+                return name, None, "Failed to fetch the consumption"
+
+        engine = CostEngine(_LOGGER, cache, site["mpan"], site["meter_serial"], site["tariff"], site["area"],
+                            strategy)
+        engine.update()
+        return name, engine.report(start_day, end_day, by_day), ""
+    except Exception as e:
+        _LOGGER.error(f"run_site() - {name}: {e}")
+        return name, None, str(e)
+
+
+def print_report(name, report):
+    print()
+    print(f"{name}")
+    print(f"{'Band':<16} {'Slots':>6} {'kWh':>10} {'Agile £':>10} {'Band £':>10} {'Error £':>9} {'Error %':>8}")
+    print("=" * 74)
+    rows = [(band, report["bands"][band]) for band in Octopus.TOU_BANDS + (UNBANDED,) if band in report["bands"]]
+    for label, totals in rows + list(report["days"].items()) + [("Total", report["total"])]:
+        error_pct = f"{totals['error_pct']:>8.2f}" if totals["error_pct"] is not None else f"{'-':>8}"
+        print(f"{label:<16} {totals['slots']:>6} {totals['kwh']:>10.3f} {totals['cost'] / 100:>10.2f} "
+              f"{totals['band_cost'] / 100:>10.2f} {totals['error'] / 100:>9.2f} {error_pct}")
+
+
+if __name__ == "__main__":
+    if not sys.version_info >= (3, 11):
+        print("This program uses features which require Python 3.11 or later.")
+        exit(-1)
+
+    parser = argparse.ArgumentParser(description="Cost a meter's consumption against the AgileWall bands")
+    parser.add_argument("-c", "--config", default=None, dest="config", type=str,
+                        help="Fleet config file (JSON) - cost every site with meter details")
+    parser.add_argument("-t", "--tariff", default=None, dest="tariff", type=str,
+                        help="Octopus Agile Tariff code, e.g. AGILE-23-12-06")
+    parser.add_argument("-a", "--area", default=None, dest="area", type=str,
+                        help="DNO Area Code - see https://energy-stats.uk/dno-region-codes-explained/")
+    parser.add_argument("-m", "--mpan", default=None, dest="mpan", type=str, help="Electricity meter point (MPAN)")
+    parser.add_argument("-n", "--serial", default=None, dest="serial", type=str, help="Electricity meter serial number")
+    parser.add_argument("-K", "--api_key", default=os.environ.get("OCTOPUS_API_KEY"), dest="api_key", type=str,
+                        help="Octopus account API key (default $OCTOPUS_API_KEY)")
+    parser.add_argument("-s", "--strategy", default=None, dest="strategy", type=str,
+                        help="Banding strategy, as for Backtest.py (default heuristic)")
+    parser.add_argument("-f", "--from", dest="start", type=date.fromisoformat,
+                        default=date.today() - timedelta(days=365),
+                        help="First Agile day to fetch & report (YYYY-MM-DD) - defaults to a year ago")
+    parser.add_argument("-u", "--until", dest="end", type=date.fromisoformat, default=date.today(),
+                        help="Agile day to stop reporting at, not included (YYYY-MM-DD) - defaults to today")
+    parser.add_argument("-D", "--daily", help="Report each day's costs", action="store_true", default=False)
+    parser.add_argument("-O", "--offline", help="Don't fetch new consumption - cost what is already stored",
+                        action="store_true", default=False)
+    parser.add_argument("-w", "--workers", default=None, dest="workers", type=int,
+                        help=f"Number of sites processed concurrently (default {DEFAULT_WORKERS})")
+    parser.add_argument("-k", "--cache_file", default=RateCache.DEFAULT_CACHE_FILE, dest="cache_file", type=str,
+                        help="Local rate store holding the rates, consumption & costs")
+    parser.add_argument("-o", "--output", default=None, dest="output", type=str,
+                        help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    workers = args.workers or DEFAULT_WORKERS
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        workers = args.workers or config.get("workers", DEFAULT_WORKERS)
+        sites = [dict(site, api_key=site.get("api_key", args.api_key)) for site in config["sites"]
+                 if site.get("mpan") and site.get("meter_serial")]
+        if not sites:
+            parser.error(f"No sites in {args.config} have an mpan & meter_serial")
+    elif args.tariff and args.area and args.mpan and args.serial:
+        sites = [{"tariff": args.tariff, "area": args.area, "mpan": args.mpan, "meter_serial": args.serial,
+                  "api_key": args.api_key, "strategy": args.strategy}]
+    else:
+        parser.error("Either a fleet config file (-c), or the tariff, area, MPAN & meter serial are needed")
+
+    if not args.offline and not all(site["api_key"] for site in sites):
+        parser.error("An Octopus API key (-K or $OCTOPUS_API_KEY) is needed to fetch consumption")
+
+    with RateCache.RateCache(args.cache_file) as rate_cache:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda site: run_site(site, rate_cache, args.start, args.end, args.offline,
+                                                          args.daily), sites))
+
+    failed = 0
+    for site_name, site_report, error in results:
+        if site_report is None:
+            failed += 1
+            print(f"\n{site_name}: {error}")
+        else:
+            print_report(site_name, site_report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({site_name: site_report for site_name, site_report, _ in results}, f, indent=4)
+
+    if failed:
+        exit(-3)
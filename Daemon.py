@@ -0,0 +1,100 @@
+import json
+import time
+import random
+from datetime import datetime, date, timedelta
+import Files
+import RateCache
+
+# Daemon mode: keep the process (and its Octopus / Tesla sessions) running, poll Octopus around the time the
+# next day's Agile rates are published, and run the pipeline as soon as a complete day of rates is available.
+# The current state and next scheduled action are written to a JSON status file.
+
+DEFAULT_STATUS_FILE = "agilewall_status.json"
+DEFAULT_PUBLISH_TIME = "16:00"      # Octopus normally publishes the next day's Agile rates at around 4pm
+POLL_INTERVAL_MIN = 60              # Seconds between polls, doubling after each miss up to the maximum
+POLL_INTERVAL_MAX = 15 * 60
+POLL_JITTER = 0.2                   # +/- 20% random jitter on each poll interval
+
+
+class Daemon:
+
+    def __init__(self, logger, agile, tariff_code, area_code, run_pipeline, status_file=DEFAULT_STATUS_FILE,
+                 publish_time=DEFAULT_PUBLISH_TIME):
+        self._LOGGER = logger
+        self.agile = agile
+        self.tariff_code = tariff_code
+        self.area_code = area_code
+        self.run_pipeline = run_pipeline    # Returns the AgileWall exit code
+        self.status_file = status_file
+        self.publish_time = datetime.strptime(publish_time, "%H:%M").time()
+
+        self.last_day = None        # Day whose Agile rates were last processed successfully
+        self.last_result = None
+        self.last_run_at = None
+        self.last_error = None      # The exception which ended the last poll, if it failed
+
+    def run(self):
+        try:
+            while True:
+                today = date.today()
+                if self.last_day == today:
+                    # Done for today - wait for tomorrow's publication window
+                    self.__sleep_until(datetime.combine(today + timedelta(days=1), self.publish_time), "waiting")
+                    continue
+
+                publish_at = datetime.combine(today, self.publish_time)
+                if datetime.now() < publish_at:
+                    self.__sleep_until(publish_at, "waiting")
+                    continue
+
+                self.__poll(today)
+        except KeyboardInterrupt:
+            self.__write_status("stopped", "none", None)
+
+    def __poll(self, today):
+        interval = POLL_INTERVAL_MIN
+        # Slots in the Agile day starting at 23:00 local time today - 46 or 50 over a clock change
+        day_slots = RateCache.period_slots(*RateCache.period_bounds(today))
+        while date.today() == today:
+            state = "polling"
+            try:
+                # get_agile_rates() fetches the Agile day starting at 23:00 today
+                slot_count = len(self.agile.get_agile_rates(self.tariff_code, self.area_code, 0))
+                if slot_count == day_slots:
+                    self.__write_status("running", "run pipeline", datetime.now())
+                    self.last_result = self.run_pipeline()
+                    self.last_run_at = datetime.now().isoformat(timespec="seconds")
+                    self.last_error = None
+                    self._LOGGER.info(f"Daemon - pipeline finished, result={self.last_result}")
+                    if self.last_result in (0, 1):
+                        self.last_day = today
+                        return
+                else:
+                    self._LOGGER.info(f"Daemon - {slot_count} of {day_slots} time slots published, polling again")
+            except Exception as e:
+                # Anything the pipeline doesn't handle (e.g. a Tesla API HTTP error) mustn't stop the daemon - it
+                # is logged, and the poll is retried after the back-off
+                self._LOGGER.exception(f"Daemon - poll failed: {e!r}")
+                self.last_run_at = datetime.now().isoformat(timespec="seconds")
+                self.last_error = repr(e)
+                state = "error"
+
+            delay = interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+            self.__sleep_until(datetime.now() + timedelta(seconds=delay), state)
+            interval = min(interval * 2, POLL_INTERVAL_MAX)
+
+    def __sleep_until(self, when, state):
+        next_action = "poll Octopus for the next day's Agile rates"
+        self.__write_status(state, next_action, when)
+        time.sleep(max(0.0, (when - datetime.now()).total_seconds()))
+
+    def __write_status(self, state, next_action, next_action_at):
+        status = {"state": state,
+                  "next_action": next_action,
+                  "next_action_at": next_action_at.isoformat(timespec="seconds") if next_action_at else None,
+                  "last_day": self.last_day.isoformat() if self.last_day else None,
+                  "last_result": self.last_result,
+                  "last_run_at": self.last_run_at,
+                  "last_error": self.last_error,
+                  "updated_at": datetime.now().isoformat(timespec="seconds")}
+        Files.atomic_write(self.status_file, json.dumps(status, indent=4))
@@ -0,0 +1,20 @@
+import os
+import threading
+
+# File helpers shared by the modules which write state, status, chart and cache files.
+
+
+def atomic_write(file_name, text, opener=open):
+    # Write the text to a temporary file in the same directory, then rename it over file_name - readers never
+    # see a half written file, and a crash can't leave a truncated one. The temporary file is named for the
+    # process & thread, so concurrent writers (e.g. the fleet and cost workers) never share one, and is created
+    # by opener (e.g. gzip.open) with the same permissions as a file written directly.
+    temp_name = f"{file_name}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with opener(temp_name, "wt") as f:
+            f.write(text)
+        os.replace(temp_name, file_name)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
@@ -0,0 +1,153 @@
+import sys
+import json
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import Octopus
+import Tesla
+import RateCache
+import TariffState
+
+# Fleet mode: drive many Powerwalls from one process.
+# Each distinct tariff / DNO area schedule is fetched from Octopus once, then the banding / merge / build
+# pipeline and the Tesla update for every site are fanned out across a bounded worker pool.
+#
+# Config file format (JSON):
+# {
+#     "workers": 4,
+#     "sites": [
+#         {"name": "Home", "tariff": "AGILE-23-12-06", "area": "N", "tesla_id": "me@example.com", "peak": true,
+#          "battery": "<optional battery id, energy site id or site name>"},
+#         ...
+#     ]
+# }
+#
+# Sites may also give their meter details ("mpan", "meter_serial" & "api_key"), so Costs.py can cost their
+# consumption against the bands.
+
+_LOGGER = logging.getLogger("AgileWall")
+
+DEFAULT_WORKERS = 4
+
+
+class SiteResult:
+    def __init__(self, name, outcome, slot_count=0, period_count=0, error=""):
+        self.name = name
+        self.outcome = outcome
+        self.slot_count = slot_count
+        self.period_count = period_count
+        self.error = error
+
+    def __repr__(self):
+        return f"{self.name}, {self.outcome}, {self.slot_count}, {self.period_count}, {self.error}"
+
+
+def fetch_regions(sites, day_offset, rate_cache):
+    # Fetch each distinct tariff / area schedule once - returns {(tariff, area): (agile, time slots)}
+    regions = {}
+    for site in sites:
+        key = (site["tariff"], site["area"])
+        if key not in regions:
+            agile = Octopus.Agile(_LOGGER, rate_cache)
+            regions[key] = (agile, agile.get_agile_rates(site["tariff"], site["area"], day_offset))
+    return regions
+
+
+def run_site(site, agile, agile_time_slots, list_only, tariff_state=None, skip_read=False):
+    name = site.get("name", site["tesla_id"])
+    if not agile_time_slots:
+        return SiteResult(name, "NO_RATES", error="No Agile Tariff found")
+
+    try:
+        schedule = agile.build_schedule(agile_time_slots, site.get("peak", False))
+        period_count = sum(len(periods) for periods in schedule.tou_periods.values())
+
+        if list_only:
+            return SiteResult(name, "LISTED", len(agile_time_slots), period_count)
+
+        new_tariff = TariffState.normalise(schedule.tou_rates, schedule.tou_periods)
+        new_digest = TariffState.digest(new_tariff)
+        state_key = TariffState.TariffState.key(site["tesla_id"], site.get("battery"))
+        if skip_read and tariff_state is not None and tariff_state.get_digest(state_key) == new_digest:
+            return SiteResult(name, "UNCHANGED", len(agile_time_slots), period_count)
+
+        with Tesla.Powerwall(site["tesla_id"], interactive=False, battery_id=site.get("battery")) as powerwall:
+            pw_tariff = powerwall.get_tariff()
+            changes = TariffState.diff(TariffState.tariff_section(pw_tariff), new_tariff)
+            if changes:
+                Tesla.Powerwall.update_tariff(pw_tariff, schedule.tou_rates, schedule.tou_periods)
+                res = powerwall.set_tariff(pw_tariff)
+                if not res == "Updated":
+                    return SiteResult(name, "FAILED", len(agile_time_slots), period_count,
+                                      f"set_tariff returned {res}")
+
+        if tariff_state is not None:
+            tariff_state.set_digest(state_key, new_digest)
+        if not changes:
+            return SiteResult(name, "UNCHANGED", len(agile_time_slots), period_count)
+        return SiteResult(name, "UPDATED", len(agile_time_slots), period_count)
+    except Exception as e:
+        _LOGGER.error(f"run_site() - {name}: {e}")
+        return SiteResult(name, "FAILED", error=str(e))
+
+
+def run_fleet(sites, workers=DEFAULT_WORKERS, day_offset=0, list_only=False, rate_cache=None, tariff_state=None,
+              skip_read=False):
+    regions = fetch_regions(sites, day_offset, rate_cache)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_site, site, *regions[(site["tariff"], site["area"])], list_only,
+                               tariff_state, skip_read)
+                   for site in sites]
+        return [future.result() for future in futures]
+
+
+def print_summary(results):
+    print()
+    print(f"{'Site':<24} {'Outcome':<10} {'Slots':>5} {'Periods':>7}  Error")
+    print("=" * 64)
+    for result in results:
+        print(f"{result.name:<24} {result.outcome:<10} {result.slot_count:>5} {result.period_count:>7}  {result.error}")
+
+    failed = [result for result in results if result.outcome in ("FAILED", "NO_RATES")]
+    print(f"{len(results)} sites, {len(failed)} failed")
+    return len(failed) == 0
+
+
+if __name__ == "__main__":
+    if not sys.version_info >= (3, 11):
+        print("This program uses features which require Python 3.11 or later.")
+        exit(-1)
+
+    parser = argparse.ArgumentParser(description="Octopus Agile to Tesla Powerwall Integration - Fleet Mode")
+    parser.add_argument("-f", "--config", dest="config", type=str, required=True,
+                        help="Fleet config file (JSON) listing the sites to update")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=None,
+                        help=f"Number of sites processed concurrently (default {DEFAULT_WORKERS})")
+    parser.add_argument("-L", "--list_only", help="Build the schedules, but don't send to the Powerwalls",
+                        action="store_true", default=False)
+    parser.add_argument("-d", "--delta", default=0, dest="delta", type=int,
+                        help="Days into the past to fetch Agile Schedule - Does not update Powerwalls")
+    parser.add_argument("-k", "--cache_file", default=RateCache.DEFAULT_CACHE_FILE, dest="cache_file", type=str,
+                        help="Local Agile rate cache file - previously fetched rates are served from here.")
+    parser.add_argument("-s", "--state_file", default=TariffState.DEFAULT_STATE_FILE, dest="state_file", type=str,
+                        help="File recording the tariff last sent to each Powerwall.")
+    parser.add_argument("-S", "--skip_read", help="Don't read a Powerwall's tariff if its schedule is unchanged "
+                        "since the last update sent", action="store_true", default=False)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    with RateCache.RateCache(args.cache_file) as cache:
+        fleet_results = run_fleet(config["sites"],
+                                  args.workers or config.get("workers", DEFAULT_WORKERS),
+                                  0 - args.delta,
+                                  args.list_only or args.delta != 0,
+                                  cache,
+                                  TariffState.TariffState(args.state_file),
+                                  args.skip_read)
+
+    if not print_summary(fleet_results):
+        exit(-3)
+    exit(0)
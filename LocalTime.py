@@ -0,0 +1,85 @@
+from bisect import bisect_right
+from datetime import datetime, timezone
+
+# Time slots are parsed once, at ingest, into integer UTC epoch seconds. Local wall clock times are then
+# derived from a cached table of UTC offset transitions, rather than a time zone lookup for every slot.
+
+LOCAL_TZ = 'Europe/London'
+DAY_SECONDS = 24 * 60 * 60
+
+
+def to_epoch(time_utc):
+    # Octopus timestamps are ISO 8601 UTC strings, e.g. "2024-03-16T23:00:00Z"
+    return int(datetime.fromisoformat(time_utc).timestamp())
+
+
+def to_utc_string(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class LocalClock:
+
+    def __init__(self, tz_name=LOCAL_TZ):
+        from dateutil import tz
+        self.zone = tz.gettz(tz_name)
+        # (transitions, offsets, table_from, table_to) - offsets[i] applies from the epoch transitions[i].
+        # Replaced as a whole when it is extended, so it can be shared between threads.
+        self.table = ([], [], 0, 0)
+
+    def utc_offset(self, epoch):
+        transitions, offsets, table_from, table_to = self.table
+        if not table_from <= epoch < table_to:
+            transitions, offsets, table_from, table_to = self.__build_table(epoch)
+        return offsets[bisect_right(transitions, epoch) - 1]
+
+    def local_epoch(self, epoch):
+        return epoch + self.utc_offset(epoch)
+
+    def hour_minute(self, epoch):
+        # Local (hour, minute) for a UTC epoch
+        local_day_seconds = self.local_epoch(epoch) % DAY_SECONDS
+        return local_day_seconds // 3600, (local_day_seconds % 3600) // 60
+
+    def day_of_week(self, epoch):
+        # Local day of the week, 0=Sunday (as used by the Tesla ToU periods)
+        return (self.local_epoch(epoch) // DAY_SECONDS + 4) % 7
+
+    def __offset(self, epoch):
+        return int(datetime.fromtimestamp(epoch, self.zone).utcoffset().total_seconds())
+
+    def __build_table(self, epoch):
+        # (Re)build the table to cover whole years, from the earliest to the latest year seen so far
+        year = datetime.fromtimestamp(epoch, timezone.utc).year
+        start = int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp())
+        end = int(datetime(year + 1, 1, 1, tzinfo=timezone.utc).timestamp())
+        if self.table[0]:
+            start = min(start, self.table[2])
+            end = max(end, self.table[3])
+
+        transitions = [start]
+        offsets = [self.__offset(start)]
+        # Offsets change at most once a day, so sample daily and then search for the exact second
+        for day in range(start + DAY_SECONDS, end + DAY_SECONDS, DAY_SECONDS):
+            if self.__offset(day) != offsets[-1]:
+                low, high = day - DAY_SECONDS, day
+                while high - low > 1:
+                    mid = (low + high) // 2
+                    if self.__offset(mid) == offsets[-1]:
+                        low = mid
+                    else:
+                        high = mid
+                transitions.append(high)
+                offsets.append(self.__offset(high))
+
+        self.table = (transitions, offsets, start, end)
+        return self.table
+
+
+_CLOCKS = {}
+
+
+def get_clock(tz_name=LOCAL_TZ):
+    # Shared clock (and transition table) per time zone
+    if tz_name not in _CLOCKS:
+        _CLOCKS[tz_name] = LocalClock(tz_name)
+    return _CLOCKS[tz_name]
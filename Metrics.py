@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+import Files
+
+# Per run instrumentation: wall time of each pipeline stage, HTTP latency & payload sizes, slot counts and the
+# outcome of the run. Each run is appended to a JSON lines file, and the latest run (plus running totals) is
+# written as a Prometheus text format file, e.g. for the node exporter textfile collector.
+
+DEFAULT_JSON_FILE = "agilewall_metrics.jsonl"
+DEFAULT_PROM_FILE = "agilewall_metrics.prom"
+PREFIX = "agilewall"
+
+
+class RunMetrics:
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}        # stage -> {"seconds": wall time, "outcome": "ok" / "error"}
+        self.values = {}        # name -> value, e.g. slot counts and payload sizes
+        self.http = []          # one entry per HTTP request
+        self.exit_code = None
+        self.duration = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            self.record_stage(name, time.perf_counter() - start, outcome)
+
+    def record_stage(self, name, seconds, outcome="ok"):
+        with self._lock:
+            # A stage run more than once in a run (e.g. per band) accumulates its time
+            seconds += self.stages.get(name, {}).get("seconds", 0)
+            self.stages[name] = {"seconds": round(seconds, 6), "outcome": outcome}
+
+    def set_value(self, name, value):
+        with self._lock:
+            self.values[name] = value
+
+    def record_http(self, service, method, status, seconds, size):
+        with self._lock:
+            self.http.append({"service": service, "method": method, "status": status,
+                              "seconds": round(seconds, 6), "bytes": size})
+
+    def finish(self, exit_code):
+        self.exit_code = exit_code
+        self.duration = round(time.time() - self.started, 6)
+
+    def to_dict(self):
+        return {"timestamp": round(self.started, 3), "duration": self.duration, "exit_code": self.exit_code,
+                "stages": self.stages, "values": self.values, "http": self.http}
+
+    def write_json_line(self, file_name):
+        with open(file_name, "a") as f:
+            f.write(json.dumps(self.to_dict(), separators=(",", ":")) + "\n")
+
+    def write_prometheus(self, file_name):
+        # Counters carry on from the previous file, so they accumulate over runs
+        counters = _load_counters(file_name)
+        _add(counters, f'{PREFIX}_runs_total{{exit_code="{self.exit_code}"}}', 1)
+        for request in self.http:
+            labels = f'service="{request["service"]}",status="{request["status"]}"'
+            _add(counters, f"{PREFIX}_http_requests_total{{{labels}}}", 1)
+
+        lines = [f"# HELP {PREFIX}_run_duration_seconds Wall time of the last AgileWall run",
+                 f"# TYPE {PREFIX}_run_duration_seconds gauge",
+                 f"{PREFIX}_run_duration_seconds {self.duration}",
+                 f"# HELP {PREFIX}_run_exit_code Exit code of the last AgileWall run",
+                 f"# TYPE {PREFIX}_run_exit_code gauge",
+                 f"{PREFIX}_run_exit_code {self.exit_code}",
+                 f"# HELP {PREFIX}_run_timestamp_seconds Start time of the last AgileWall run",
+                 f"# TYPE {PREFIX}_run_timestamp_seconds gauge",
+                 f"{PREFIX}_run_timestamp_seconds {round(self.started, 3)}",
+                 f"# HELP {PREFIX}_stage_seconds Wall time of each pipeline stage in the last run",
+                 f"# TYPE {PREFIX}_stage_seconds gauge"]
+        lines += [f'{PREFIX}_stage_seconds{{stage="{name}",outcome="{stage["outcome"]}"}} {stage["seconds"]}'
+                  for name, stage in self.stages.items()]
+
+        lines += [f"# HELP {PREFIX}_http_request_seconds Latency of each HTTP request in the last run",
+                  f"# TYPE {PREFIX}_http_request_seconds gauge"]
+        lines += [f'{PREFIX}_http_request_seconds{{service="{request["service"]}",method="{request["method"]}",'
+                  f'request="{index}"}} {request["seconds"]}' for index, request in enumerate(self.http)]
+        lines += [f"# HELP {PREFIX}_http_response_bytes Payload size of each HTTP request in the last run",
+                  f"# TYPE {PREFIX}_http_response_bytes gauge"]
+        lines += [f'{PREFIX}_http_response_bytes{{service="{request["service"]}",method="{request["method"]}",'
+                  f'request="{index}"}} {request["bytes"]}' for index, request in enumerate(self.http)]
+
+        lines += [f"# HELP {PREFIX}_value Slot counts and payload sizes from the last run",
+                  f"# TYPE {PREFIX}_value gauge"]
+        lines += [f'{PREFIX}_value{{name="{name}"}} {value}' for name, value in self.values.items()]
+
+        for name in sorted({metric.split("{")[0] for metric in counters}):
+            lines += [f"# TYPE {name} counter"]
+            lines += [f"{metric} {value}" for metric, value in counters.items() if metric.split("{")[0] == name]
+
+        Files.atomic_write(file_name, "\n".join(lines) + "\n")
+
+
+def _load_counters(file_name):
+    counters = {}
+    if not os.path.exists(file_name):
+        return counters
+
+    with open(file_name) as f:
+        for line in f:
+            if line.startswith(f"{PREFIX}_") and "_total" in line.split("{")[0]:
+                metric, value = line.rsplit(" ", 1)
+                counters[metric] = int(float(value))
+    return counters
+
+
+def _add(counters, metric, value):
+    counters[metric] = counters.get(metric, 0) + value
@@ -1,9 +1,20 @@
 from enum import Enum, auto
-import requests
+import RateCache
+import LocalTime
+import Thresholds
+import RateArrays
+import OctopusClient
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import nullcontext
 from datetime import timedelta, date
-from dateutil import parser, tz
 
 LOCAL_TZ = 'Europe/London'
+OCTOPUS_API_URL = "https://api.octopus.energy/v1"
+RATE_PAGE_SIZE = 1500       # Largest page the Octopus API will return
+RANGE_WORKERS = 8           # Concurrent page requests for bulk range fetches
+CONSUMPTION_PAGE_SIZE = 25000   # Largest consumption page the Octopus API will return (~17 months of slots)
 
 
 class RateType(Enum):
@@ -15,6 +26,9 @@ class RateType(Enum):
 
 
 class RateTimeSlot:
+    # valid_from / valid_to are UTC epoch seconds - parsed once when the rates are fetched
+    __slots__ = ("valid_from", "valid_to", "price_exc", "price_inc", "tariff")
+
     def __init__(self, valid_from, valid_to, price_exc, price_inc, tariff=RateType.UNKNOWN):
         self.valid_from = valid_from
         self.valid_to = valid_to
@@ -23,7 +37,171 @@ class RateTimeSlot:
         self.tariff = tariff
 
     def __repr__(self):
-        return f"{self.valid_from}, {self.valid_to}, {str(self.price_exc)}, {str(self.price_inc)}, {str(self.tariff)}"
+        return (f"{LocalTime.to_utc_string(self.valid_from)}, {LocalTime.to_utc_string(self.valid_to)}, "
+                f"{str(self.price_exc)}, {str(self.price_inc)}, {str(self.tariff)}")
+
+
+class RateRow:
+    # Lightweight view of one row of a RateSchedule - reads the same attributes as a RateTimeSlot
+    __slots__ = ("schedule", "index")
+
+    def __init__(self, schedule, index):
+        self.schedule = schedule
+        self.index = index
+
+    @property
+    def valid_from(self):
+        return self.schedule.valid_from[self.index]
+
+    @property
+    def valid_to(self):
+        return self.schedule.valid_to[self.index]
+
+    @property
+    def price_exc(self):
+        return self.schedule.price_exc[self.index]
+
+    @property
+    def price_inc(self):
+        return self.schedule.price_inc[self.index]
+
+    @property
+    def tariff(self):
+        return RateType(self.schedule.tariff[self.index])
+
+    def __repr__(self):
+        return (f"{LocalTime.to_utc_string(self.valid_from)}, {LocalTime.to_utc_string(self.valid_to)}, "
+                f"{str(self.price_exc)}, {str(self.price_inc)}, {str(self.tariff)}")
+
+
+class RateSchedule:
+    # Compact, column oriented store of rate time slots - one typed array per attribute (~33 bytes per slot).
+    # `rows` selects the rows of the columns which belong to this schedule, either a range (e.g. a time slice)
+    # or an array of row numbers (e.g. a rate band), so slices share the underlying columns without copying.
+    __slots__ = ("valid_from", "valid_to", "price_exc", "price_inc", "tariff", "rows")
+
+    def __init__(self, valid_from=None, valid_to=None, price_exc=None, price_inc=None, tariff=None, rows=None):
+        self.valid_from = array('q') if valid_from is None else valid_from   # UTC epoch seconds
+        self.valid_to = array('q') if valid_to is None else valid_to
+        self.price_exc = array('d') if price_exc is None else price_exc
+        self.price_inc = array('d') if price_inc is None else price_inc
+        self.tariff = array('b', [RateType.UNKNOWN.value]) * len(self.valid_from) if tariff is None else tariff
+        self.rows = range(len(self.valid_from)) if rows is None else rows
+
+    @classmethod
+    def from_rows(cls, rows):
+        # rows: iterable of (valid_from, valid_to, price_exc, price_inc)
+        schedule = cls()
+        for valid_from, valid_to, price_exc, price_inc in rows:
+            schedule.append(valid_from, valid_to, price_exc, price_inc)
+        return schedule
+
+    @classmethod
+    def of(cls, rate_time_slots):
+        # Accept either a RateSchedule, or any iterable of RateTimeSlot-like objects
+        if isinstance(rate_time_slots, RateSchedule):
+            return rate_time_slots
+
+        schedule = cls()
+        for item in rate_time_slots:
+            schedule.append(item.valid_from, item.valid_to, item.price_exc, item.price_inc, item.tariff)
+        return schedule
+
+    def append(self, valid_from, valid_to, price_exc, price_inc, tariff=RateType.UNKNOWN):
+        # Only valid on a schedule which owns its columns (not a slice)
+        self.valid_from.append(valid_from)
+        self.valid_to.append(valid_to)
+        self.price_exc.append(price_exc)
+        self.price_inc.append(price_inc)
+        self.tariff.append(tariff.value)
+        self.rows = range(len(self.valid_from))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for index in self.rows:
+            yield RateRow(self, index)
+
+    def __getitem__(self, position):
+        return RateRow(self, self.rows[position])
+
+    def __repr__(self):
+        return f"RateSchedule({len(self)} slots)"
+
+    def values(self, column):
+        # The values of one column for the rows in this schedule, e.g. values("price_inc")
+        data = getattr(self, column)
+        if isinstance(self.rows, range) and self.rows.step == 1:
+            return data[self.rows.start:self.rows.stop]
+        return array(data.typecode, [data[index] for index in self.rows])
+
+    def vector(self, column):
+        # NumPy version of values() - only when RateArrays.enabled()
+        return RateArrays.column(getattr(self, column), self.rows)
+
+    def is_time_ordered(self):
+        valid_from = self.valid_from
+        return all(valid_from[a] <= valid_from[b] for a, b in zip(self.rows, self.rows[1:]))
+
+    def sorted_by_time(self):
+        if self.is_time_ordered():
+            return self
+
+        order = sorted(self.rows, key=self.valid_from.__getitem__)
+        return RateSchedule(*(array(column.typecode, [column[index] for index in order])
+                              for column in (self.valid_from, self.valid_to, self.price_exc, self.price_inc,
+                                             self.tariff)))
+
+    def between(self, period_from, period_to):
+        # Time slice of a time ordered schedule - slots starting from period_from, up to (not including) period_to
+        start = bisect_left(self.rows, period_from, key=self.valid_from.__getitem__)
+        stop = bisect_left(self.rows, period_to, key=self.valid_from.__getitem__)
+        return RateSchedule(self.valid_from, self.valid_to, self.price_exc, self.price_inc, self.tariff,
+                            self.rows[start:stop])
+
+    def by_band(self, rate_type):
+        tariff = self.tariff
+        return RateSchedule(self.valid_from, self.valid_to, self.price_exc, self.price_inc, self.tariff,
+                            array('l', [index for index in self.rows if tariff[index] == rate_type.value]))
+
+    def merge_adjacent(self):
+        # Merge each run of adjacent time slots into one slot with the average unit prices (rounded to 3 decimals)
+        if RateArrays.enabled(len(self)):
+            return RateSchedule(*RateArrays.merge_runs(*(self.vector(column) for column in self.__slots__[:5])))
+
+        merged = RateSchedule()
+        valid_from, valid_to = self.valid_from, self.valid_to
+        price_exc, price_inc, tariff = self.price_exc, self.price_inc, self.tariff
+        first = None
+        for index in self.rows:
+            if first is not None and valid_from[index] == run_to:
+                run_to = valid_to[index]
+                total_exc += price_exc[index]
+                total_inc += price_inc[index]
+                count += 1
+                continue
+
+            if first is not None:
+                merged.__append_run(self, first, run_to, total_exc, total_inc, count)
+
+            first = index
+            run_to = valid_to[index]
+            total_exc = price_exc[index]
+            total_inc = price_inc[index]
+            count = 1
+
+        if first is not None:
+            merged.__append_run(self, first, run_to, total_exc, total_inc, count)
+        return merged
+
+    def __append_run(self, source, first, run_to, total_exc, total_inc, count):
+        if count == 1:
+            self.append(source.valid_from[first], run_to, source.price_exc[first], source.price_inc[first],
+                        RateType(source.tariff[first]))
+        else:
+            self.append(source.valid_from[first], run_to, round(total_exc / count, 3), round(total_inc / count, 3),
+                        RateType(source.tariff[first]))
 
 
 class TimeOfUseSlot:
@@ -40,86 +218,220 @@ class TimeOfUseSlot:
                 f"{self.fromMinute}, {self.toHour}, {self.toMinute}")
 
 
+# Tesla Powerwall Utility Rate Plan band names, in price order
+TOU_BANDS = ("SUPER_OFF_PEAK", "OFF_PEAK", "PARTIAL_PEAK", "ON_PEAK")
+
+
+class TariffSchedule:
+    # Result of the banding / merge / build pipeline for one set of Agile rates - each attribute is keyed by
+    # the Tesla band name (see TOU_BANDS)
+    def __init__(self, slots, merged, tou_periods, rates, tou_rates):
+        self.slots = slots              # Time slots in each band
+        self.merged = merged            # Adjacent time slots merged, with the averaged unit price
+        self.tou_periods = tou_periods  # Tesla ToU periods for each band
+        self.rates = rates              # Average unit price of each band (pence)
+        self.tou_rates = tou_rates      # Tesla Energy Charges (GBP)
+
+    def __repr__(self):
+        return f"{self.rates}, {self.tou_periods}"
+
+
 class Agile:
 
-    def __init__(self, logger):
+    def __init__(self, logger, cache=None, api_url=OCTOPUS_API_URL, thresholds=Thresholds.HEURISTIC,
+                 period_penalty=Thresholds.DEFAULT_PERIOD_PENALTY, threshold_factors=Thresholds.DEFAULT_FACTORS,
+                 client=None, today=None):
         self._LOGGER = logger
+        self.cache = cache      # Optional RateCache.RateCache - serves already fetched slots without network I/O
+        self.api_url = api_url
+        self.client = client    # OctopusClient.OctopusClient - the shared client is used when first needed
+        self.thresholds = thresholds            # Band threshold strategy - see Thresholds.STRATEGIES
+        self.period_penalty = period_penalty    # Optimal thresholds - price error (pence^2) worth one ToU period
+        self.threshold_factors = threshold_factors  # Heuristic thresholds - see Thresholds.heuristic_limits()
+        self.metrics = None     # Optional Metrics.RunMetrics - records stage timings & HTTP requests for a run
+        self.today = today      # Date the day offsets count from, e.g. a replayed run's - defaults to today
         self.LIMIT_SUPER_OFF_PEAK = 0
         self.LIMIT_OFF_PEAK = 0
         self.LIMIT_MID_PEAK = 0
         self.MIN = 0
         self.MAX = 0
 
-    def get_agile_rates(self, tariff_code, area_code, day_offset=0):
+    def get_agile_rates(self, tariff_code, area_code, day_offset=0, days=1):
         # Note: Octopus Agile API returns tariff data in UTC
         # Check day offset is =< 0 as we can only get Agile rates for today/tomorrow or earlier days
         if day_offset > 0:
             self._LOGGER.error(
                 f"get_agile_rates(): Attempt to fetch future tariffs, day_offset must be =< 0, day_offset={day_offset}")
-            return []
+            return RateSchedule()
 
-        base_url = f"https://api.octopus.energy/v1/products/{tariff_code}/electricity-tariffs"
+        # Several days are the window of Agile days ending with the day_offset day
+        start_day = (self.today or date.today()) + timedelta(days=day_offset - (days - 1))
+        period_from, period_to = RateCache.period_bounds(start_day, days)
 
-        start_day = date.today() + timedelta(days=day_offset)
-        end_day = date.today() + timedelta(days=day_offset + 1)
-
-        date_from = f"{start_day.strftime('%Y-%m-%d')}T23:00"
-        date_to = f"{end_day.strftime('%Y-%m-%d')}T23:00"
-
-        date_from = f"?period_from={date_from}"
-        if date_to is not None:
-            date_to = f"&period_to={date_to}"
+        if self.cache is None:
+            rate_slot_array = self.__fetch_rate_slots(tariff_code, area_code, period_from, period_to)
         else:
-            date_to = ""
-        headers = {"content-type": "application/json"}
-        url = f"{base_url}/"f"E-1R-{tariff_code}-{area_code}/" f"standard-unit-rates/{date_from}{date_to}"
-        print(url)
-        self._LOGGER.info(f"get_agile_rates() - url ={url}")
+            rate_slot_array = self.__get_cached_rate_slots(tariff_code, area_code, period_from, period_to)
 
-        r = requests.get(url, headers=headers)
-        results = r.json()["results"]
-        if len(results) == 0:
+        if rate_slot_array is None:
+            return RateSchedule()   # The fetch failed (already logged)
+        if len(rate_slot_array) == 0:
             self._LOGGER.error(
                 f"get_agile_rates() - Tariffs not yet available for time period starting:"
                 f" {start_day.strftime('%Y-%m-%d')}T23:00")
-            return []
+            return RateSchedule()
 
-        rate_slot_array = []
-        for rate in results:
-            res = RateTimeSlot(rate["valid_from"], rate["valid_to"], rate["value_exc_vat"], rate["value_inc_vat"])
-            rate_slot_array.append(res)
+        # Only a complete window is used - a schedule built from part of it would be sent to the Powerwall as if
+        # it were current (the window runs 23:00 -> 23:00 local time, so has 46 or 50 slots a day over a clock
+        # change)
+        expected = RateCache.period_slots(period_from, period_to)
+        if len(rate_slot_array) < expected:
+            self._LOGGER.error(
+                f"get_agile_rates() - Only {len(rate_slot_array)} of the {expected} tariff slots available for the"
+                f" {days} day(s) starting: {start_day.strftime('%Y-%m-%d')}T23:00")
+            return RateSchedule()
 
         # Set the various thresholds based on the rate information
-        if self.__set_rate_limits(rate_slot_array):
+        if self.set_rate_limits(rate_slot_array):
             return rate_slot_array
         else:
             self._LOGGER.error(f"get_agile_rates() - Internal Error: Bad Threshold Configuration")
-            return []  # Bad threshold configuration - stop execution
+            return RateSchedule()  # Bad threshold configuration - stop execution
+
+    def __get_cached_rate_slots(self, tariff_code, area_code, period_from, period_to):
+        # Returns None if the missing slots couldn't be fetched
+        rows, missing = self.cache.get_rates(tariff_code, area_code, period_from, period_to)
+        self._LOGGER.info(f"get_agile_rates() - cache: {len(rows)} slots cached, {len(missing)} missing")
+
+        rate_slot_array = RateSchedule.from_rows(rows)
+
+        # Only request the span of slots which isn't already held locally
+        if missing:
+            fetched = self.__fetch_rate_slots(tariff_code, area_code,
+                                              missing[0], missing[-1] + RateCache.SLOT_SECONDS)
+            if fetched is None:
+                self._LOGGER.error(f"get_agile_rates() - failed to fetch the {len(missing)} slots not cached")
+                return None
+            self.cache.put_rates(tariff_code, area_code,
+                                 zip(fetched.valid_from, fetched.valid_to, fetched.price_exc, fetched.price_inc))
+
+            cached = set(rate_slot_array.valid_from)
+            for row in zip(fetched.valid_from, fetched.valid_to, fetched.price_exc, fetched.price_inc):
+                if row[0] not in cached:
+                    rate_slot_array.append(*row)
+
+        return rate_slot_array.sorted_by_time()
+
+    def get_agile_rates_range(self, tariff_code, area_code, start_day, end_day):
+        # Stream the Agile rates for every Agile day from start_day up to (not including) end_day, in time order.
+        # The range is split into page sized windows which are fetched concurrently, but yielded in order as
+        # each window completes, so callers can process long histories without holding them all in memory.
+        # Each slot is a RateRow view of its window's RateSchedule (RateSchedule.of() will collect them).
+        # Raises OctopusClient.OctopusError if a window can't be fetched, rather than leaving a gap in the range.
+        # Note: unlike get_agile_rates() this does not set the band thresholds.
+        from concurrent.futures import ThreadPoolExecutor
+
+        period_from, _ = RateCache.period_bounds(start_day)
+        period_to, _ = RateCache.period_bounds(end_day)
+        window = RATE_PAGE_SIZE * RateCache.SLOT_SECONDS
+        windows = iter([(t, min(t + window, period_to)) for t in range(period_from, period_to, window)])
+
+        with ThreadPoolExecutor(RANGE_WORKERS) as pool:
+            # Keep a bounded number of windows in flight ahead of the consumer
+            pending = deque()
+            for _ in range(RANGE_WORKERS * 2):
+                self.__submit_window(pool, pending, windows, tariff_code, area_code)
+
+            while pending:
+                (window_from, window_to), future = pending.popleft()
+                slots = future.result()
+                if slots is None:
+                    for _, waiting in pending:
+                        waiting.cancel()
+                    raise OctopusClient.OctopusError(
+                        f"Failed to fetch the Agile rates from {LocalTime.to_utc_string(window_from)} to "
+                        f"{LocalTime.to_utc_string(window_to)}")
+                self.__submit_window(pool, pending, windows, tariff_code, area_code)
+                yield from slots
+
+    def __submit_window(self, pool, pending, windows, tariff_code, area_code):
+        window = next(windows, None)
+        if window is None:
+            return
+
+        # Each window is queued with its bounds, so a failed window can be reported
+        fetch = self.__fetch_rate_slots if self.cache is None else self.__get_cached_rate_slots
+        pending.append((window, pool.submit(fetch, tariff_code, area_code, *window)))
 
-    def __set_rate_limits(self, rate_slot_array):
-        # Sort entire list by unit price
-        rate_slot_array.sort(key=lambda x: x.price_inc)
-        rate_min = rate_slot_array[0].price_inc
-        rate_max = rate_slot_array[-1].price_inc
+    def __fetch_rate_slots(self, tariff_code, area_code, period_from, period_to):
+        # Returns None if the slots couldn't be fetched
+        if self.client is None:
+            self.client = OctopusClient.get_client(self._LOGGER)
+        base_url = f"{self.api_url}/products/{tariff_code}/electricity-tariffs"
+
+        date_from = f"?period_from={LocalTime.to_utc_string(period_from)}"
+        date_to = f"&period_to={LocalTime.to_utc_string(period_to)}"
+        url = (f"{base_url}/"f"E-1R-{tariff_code}-{area_code}/" f"standard-unit-rates/{date_from}{date_to}"
+               f"&page_size={RATE_PAGE_SIZE}")
+        print(url)
+        self._LOGGER.info(f"get_agile_rates() - url ={url}")
+
+        rate_slot_array = RateSchedule()
+        # Follow the pagination links until the whole period has been returned
+        while url:
+            try:
+                page = self.client.get_json(url, self.metrics)
+                results = page["results"]
+            except (OctopusClient.OctopusError, KeyError, TypeError) as e:
+                self._LOGGER.error(f"get_agile_rates() - failed to fetch {url}: {e!r}")
+                return None
+
+            with self.__stage("octopus_parse"):
+                for rate in results:
+                    rate_slot_array.append(LocalTime.to_epoch(rate["valid_from"]),
+                                           LocalTime.to_epoch(rate["valid_to"]),
+                                           rate["value_exc_vat"], rate["value_inc_vat"])
+            url = page.get("next")
+
+        # Octopus returns the newest slots first - the rest of the pipeline works on time ordered slots
+        with self.__stage("octopus_parse"):
+            return rate_slot_array.sorted_by_time()
+
+    def __stage(self, name):
+        # Time a stage of the pipeline, if this run is being instrumented
+        return nullcontext() if self.metrics is None else self.metrics.stage(name)
+
+    # Set the band thresholds for a set of Agile time slots - returns False if they are inconsistent
+    def set_rate_limits(self, rate_slot_array):
+        if RateArrays.enabled(len(rate_slot_array)):
+            rate_min, _, rate_max = RateArrays.price_stats(rate_slot_array.vector("price_inc"))
+        else:
+            prices = rate_slot_array.values("price_inc")
+            rate_min = min(prices)
+            rate_max = max(prices)
 
         # Calculate the overall average rate
         rate_avg = self.get_average_rate(rate_slot_array)
 
-        # Create the band limits
-        # The split between Super Off-Peak and Off-Peak rates is the midway point between average and min rate value
-        # 24-03-16: Initial testing suggests that we need to constrain the Super Off-Peak price band further, so we
-        #           can select only the cheapest prices when the lower price spread is constrained
-        self.LIMIT_SUPER_OFF_PEAK = (((rate_avg - rate_min) / 2) + rate_min) * 0.9
-        # The split between Off-Peak and Mid-Peak rates is the average rate value
-        # 24-03-16: Trying a similar constraint of the Off-Peak price band further so we
-        self.LIMIT_OFF_PEAK = rate_avg * 0.9
-        # The Peak / Mid-Peak split is calculated as all rates below 50% of the max value
-        self.LIMIT_MID_PEAK = (((rate_max - rate_avg) / 2) + rate_avg)
+        limits = None
+        if self.thresholds == Thresholds.OPTIMAL:
+            schedule = RateSchedule.of(rate_slot_array).sorted_by_time()
+            limits = Thresholds.optimal_limits(schedule.values("valid_from"), schedule.values("valid_to"),
+                                               schedule.values("price_inc"), self.period_penalty)
+            if limits is None:
+                self._LOGGER.warning("set_rate_limits() - Too few distinct prices for the optimal thresholds, "
+                                     "using the default thresholds")
+
+        if limits is not None:
+            self.LIMIT_SUPER_OFF_PEAK, self.LIMIT_OFF_PEAK, self.LIMIT_MID_PEAK = limits
+        else:
+            self.LIMIT_SUPER_OFF_PEAK, self.LIMIT_OFF_PEAK, self.LIMIT_MID_PEAK = Thresholds.heuristic_limits(
+                rate_min, rate_avg, rate_max, self.threshold_factors)
 
         self.MAX = rate_max
         self.MIN = rate_min
 
-        self._LOGGER.info(f"__set_rate_limits() - rate_min={rate_min}, rate_avg={rate_avg}, rate_max={rate_max}," +
+        self._LOGGER.info(f"set_rate_limits() - rate_min={rate_min}, rate_avg={rate_avg}, rate_max={rate_max}," +
                           f"LIMIT_SUPER_OFF_PEAK={self.LIMIT_SUPER_OFF_PEAK}, LIMIT_OFF_PEAK={self.LIMIT_OFF_PEAK}, "
                           f"LIMIT_MID_PEAK={self.LIMIT_MID_PEAK}")
 
@@ -127,147 +439,134 @@ class Agile:
         if rate_max > self.LIMIT_MID_PEAK > self.LIMIT_OFF_PEAK > self.LIMIT_SUPER_OFF_PEAK > rate_min:
             return True
         else:
-            self._LOGGER.error("__set_rate_limits() - Inconsistent Rate Thresholds found, aborting.")
+            self._LOGGER.error("set_rate_limits() - Inconsistent Rate Thresholds found, aborting.")
             return False
 
     def get_rate_min(self):
         return self
 
-    def get_super_off_peak_slots(self, agile_time_slots):
-        # Tag the Super Off-Peak slots
-        super_off_peak = []
-
-        # Tag all slots below the SuperOffPeak_Limit price as "Super Off-Peak"
-        for item in agile_time_slots:
-            if item.price_inc < self.LIMIT_SUPER_OFF_PEAK:
-                item.tariff = RateType.SUPER_OFF_PEAK
-                super_off_peak.append(item)
-
-        # Re-sort the bucket by timestamp
-        super_off_peak.sort(key=lambda x: x.valid_from)
-
-        return super_off_peak
-
-    def get_peak_slots(self, agile_time_slots):
-        peak = []
-        # Tag the Peak slots as all those above the Mid-Peak Limit
-        for item in agile_time_slots:
-            if item.price_inc > self.LIMIT_MID_PEAK:
-                item.tariff = RateType.PEAK
-                peak.append(item)
-
-        # Re-sort the bucket by timestamp
-        peak.sort(key=lambda x: x.valid_from)
-        return peak
-
-    def get_off_peak_slots(self, agile_time_slots):
-        off_peak = []
-        # Tag the Off-Peak slots
-        #  - Tag all the slots which are below the Off-Peak Limit and above the Super Off-Peak limit
-        for item in agile_time_slots:
-            if (item.price_inc >= self.LIMIT_SUPER_OFF_PEAK) & (item.price_inc <= self.LIMIT_OFF_PEAK):
-                item.tariff = RateType.OFF_PEAK
-                off_peak.append(item)
-
-        # Re-sort the bucket by timestamp
-        off_peak.sort(key=lambda x: x.valid_from)
-
-        return off_peak
-
-    def get_mid_peak_slots(self, agile_time_slots):
-        mid_peak = []
-        # Tag the Mid-Peak slots
-        for item in agile_time_slots:
-            if (item.price_inc >= self.LIMIT_OFF_PEAK) & (item.price_inc <= self.LIMIT_MID_PEAK):
-                item.tariff = RateType.MID_PEAK
-                mid_peak.append(item)
-
-        # Re-sort the bucket by timestamp
-        mid_peak.sort(key=lambda x: x.valid_from)
-
-        return mid_peak
-
-    def get_combined_peak_slots(self, agile_time_slots):
-        combined_peak = []
-        # Tag the Mid-Peak slots
-        for item in agile_time_slots:
-            if item.price_inc >= self.LIMIT_OFF_PEAK:
-                item.tariff = RateType.PEAK
-                combined_peak.append(item)
-
-        # Re-sort the bucket by timestamp
-        combined_peak.sort(key=lambda x: x.valid_from)
-
-        return combined_peak
-
-    # Recursive function to locate the last element in a chain of adjacent time slots
-    def __find_end_slot(self, rate_time_slots, length, index=0):
-        # If Start is the last element in the array, we have finished
-        if index == (length - 1):
-            return index
-
-        if rate_time_slots[index].valid_to == rate_time_slots[index + 1].valid_from:
-            return self.__find_end_slot(rate_time_slots, length, index + 1)
-        else:  # Found the end of this series of linked slots
-            return index
+    # Assign every time slot to its rate band in a single pass.
+    # The slots must be in time order (as returned by get_agile_rates), and each band is returned in time order.
+    # The shared schedule is not modified - the bands are views of a copy of it tagged with each slot's rate type.
+    # A price which falls exactly on a threshold is placed in the higher band.
+    def classify_slots(self, agile_time_slots, peak_combine=False):
+        schedule = RateSchedule.of(agile_time_slots)
+        thresholds = (self.LIMIT_SUPER_OFF_PEAK, self.LIMIT_OFF_PEAK, self.LIMIT_MID_PEAK)
+        if peak_combine:
+            # Mid-Peak & Peak are combined into a single Peak band
+            rate_types = (RateType.SUPER_OFF_PEAK, RateType.OFF_PEAK, RateType.PEAK, RateType.PEAK)
+        else:
+            rate_types = (RateType.SUPER_OFF_PEAK, RateType.OFF_PEAK, RateType.MID_PEAK, RateType.PEAK)
+        codes = [rate_type.value for rate_type in rate_types]
+
+        tariff = array('b', schedule.tariff)
+        bands = {RateType.SUPER_OFF_PEAK.value: array('l'), RateType.OFF_PEAK.value: array('l'),
+                 RateType.MID_PEAK.value: array('l'), RateType.PEAK.value: array('l')}
+        if RateArrays.enabled(len(schedule)):
+            bands.update(RateArrays.classify(schedule.rows, schedule.vector("price_inc"), thresholds, codes, tariff))
+        else:
+            price_inc = schedule.price_inc
+            for index in schedule.rows:
+                code = codes[bisect_right(thresholds, price_inc[index])]
+                tariff[index] = code
+                bands[code].append(index)
+
+        return tuple(RateSchedule(schedule.valid_from, schedule.valid_to, schedule.price_exc, schedule.price_inc,
+                                  tariff, bands[rate_type.value])
+                     for rate_type in (RateType.SUPER_OFF_PEAK, RateType.OFF_PEAK, RateType.MID_PEAK, RateType.PEAK))
+
+    # Run the banding / merge / build pipeline for a set of Agile time slots, after the band thresholds have
+    # been set by get_agile_rates(). by_day builds ToU periods for each day of the week (for slots covering
+    # several days) rather than one set of periods for every day.
+    def build_schedule(self, agile_time_slots, peak_combine=False, by_day=False):
+        # Sort the time slots into one of the 4 Utility Plan codes
+        # (Mid-Peak is empty if we are combining the Mid-Peak & Peak Tariff Bands)
+        with self.__stage("classify"):
+            slots = dict(zip(TOU_BANDS, self.classify_slots(agile_time_slots, peak_combine)))
+
+        # Process each bucket and merge any adjacent time slots
+        with self.__stage("merge"):
+            merged = {band: self.merge_adjacent_slots(slots[band]) for band in TOU_BANDS}
+
+        # Build the Tesla Time of Use data and calculate the average rate for each rate type
+        with self.__stage("build_tou"):
+            if by_day:
+                tou_periods = self.build_weekly_tou_periods(slots)
+            else:
+                tou_periods = {band: self.build_tou_periods(merged[band]) for band in TOU_BANDS}
+
+        rates = {"SUPER_OFF_PEAK": self.get_average_rate(merged["SUPER_OFF_PEAK"]),
+                 "OFF_PEAK": self.get_average_rate(merged["OFF_PEAK"])}
+        if peak_combine:
+            rates["PARTIAL_PEAK"] = round(self.MAX, 3)
+            rates["ON_PEAK"] = round(self.MAX, 3)
+        else:
+            rates["PARTIAL_PEAK"] = self.get_average_rate(merged["PARTIAL_PEAK"])
+            rates["ON_PEAK"] = self.get_average_rate(merged["ON_PEAK"])
+
+        tou_rates = self.build_tou_rates(*(rates[band] for band in TOU_BANDS))
+
+        return TariffSchedule(slots, merged, tou_periods, rates, tou_rates)
 
     # Merge any adjacent time-slots, and calculate the average unit cost for the merged slot
-    def merge_adjacent_slots(self, rate_time_slots):
+    @staticmethod
+    def merge_adjacent_slots(rate_time_slots):
+        return RateSchedule.of(rate_time_slots).merge_adjacent()
 
-        slot_count = len(rate_time_slots)
+    # Streaming version of merge_adjacent_slots() - consumes a time ordered stream of slots (e.g. from
+    # get_agile_rates_range) and yields each run of adjacent slots as one merged slot, keeping running totals
+    # so any length of run can be merged
+    @staticmethod
+    def iter_merged_slots(rate_time_slots):
+        first = None
+        for item in rate_time_slots:
+            if first is not None and item.valid_from == valid_to:
+                # Extend the current run
+                valid_to = item.valid_to
+                total_exc += item.price_exc
+                total_inc += item.price_inc
+                count += 1
+                continue
+
+            if first is not None:
+                yield Agile.__merged_slot(first, valid_to, total_exc, total_inc, count)
+
+            # Start a new run
+            first = item
+            valid_to = item.valid_to
+            total_exc = item.price_exc
+            total_inc = item.price_inc
+            count = 1
+
+        if first is not None:
+            yield Agile.__merged_slot(first, valid_to, total_exc, total_inc, count)
 
-        # If the list is empty there's nothing to do
-        if slot_count == 0:
-            return []
+    @staticmethod
+    def __merged_slot(first, valid_to, total_exc, total_inc, count):
+        if count == 1:
+            return first
 
-        merged_array = []
-
-        start = 0
-        while start < slot_count:
-            end = self.__find_end_slot(rate_time_slots, slot_count, start)
-
-            if start != end:
-                total_inc = 0
-                total_exc = 0
-                # Sum each rate for the included slots, so we can
-                # calculate an average rate for the new merged slot
-                for i in range(start, end):
-                    total_inc += rate_time_slots[i].price_inc
-                    total_exc += rate_time_slots[i].price_exc
-
-                merged_array.append(RateTimeSlot(rate_time_slots[start].valid_from,
-                                                 rate_time_slots[end].valid_to,
-                                                 # Calculate Average Rate and round to 3 decimals
-                                                 round(total_exc / (end - start), 3),
-                                                 # Calculate Average Rate and round to 3 decimals
-                                                 round(total_inc / (end - start), 3),
-                                                 rate_time_slots[start].tariff)
-                                    )
-                start = end + 1
-            else:
-                merged_array.append(rate_time_slots[start])
-                start = start + 1
-        return merged_array
+        return RateTimeSlot(first.valid_from, valid_to,
+                            # Calculate Average Rate and round to 3 decimals
+                            round(total_exc / count, 3),
+                            # Calculate Average Rate and round to 3 decimals
+                            round(total_inc / count, 3),
+                            first.tariff)
 
     @staticmethod
     def get_average_rate(rate_time_slots):
         # Calculate the overall average rate
-        total = 0
-        for item in rate_time_slots:
-            total += item.price_inc
+        schedule = RateSchedule.of(rate_time_slots)
+        if RateArrays.enabled(len(schedule)):
+            total = RateArrays.sequential_sum(schedule.vector("price_inc"))
+        else:
+            total = 0
+            for price in schedule.values("price_inc"):
+                total += price
         rate_avg = total / len(rate_time_slots)
 
         return round(rate_avg, 3)
 
-    @staticmethod
-    def __to_local_time(time_utc, dest_tz):
-
-        dest_zone = tz.gettz(dest_tz)
-        utc = parser.parse(time_utc)  # Parse Agile UTC Time String
-        local_time = utc.astimezone(dest_zone)
-
-        return local_time
-
     # Build the Tesla API data structure for ToU slots
     @staticmethod
     def build_tou_periods(rate_time_slots):
@@ -276,18 +575,65 @@ class Agile:
             return []
 
         tou_periods = []
+        clock = LocalTime.get_clock(LOCAL_TZ)
+        schedule = RateSchedule.of(rate_time_slots)
 
-        for item in rate_time_slots:
-            valid_from = Agile.__to_local_time(item.valid_from, LOCAL_TZ)
-            valid_to = Agile.__to_local_time(item.valid_to, LOCAL_TZ)
+        for valid_from, valid_to in zip(schedule.values("valid_from"), schedule.values("valid_to")):
+            from_hour, from_minute = clock.hour_minute(valid_from)
+            to_hour, to_minute = clock.hour_minute(valid_to)
 
-            tou_slot = {'fromDayOfWeek': 0, 'toDayOfWeek': 6, 'fromHour': valid_from.hour,
-                        'fromMinute': valid_from.minute, 'toHour': valid_to.hour, 'toMinute': valid_to.minute}
+            tou_slot = {'fromDayOfWeek': 0, 'toDayOfWeek': 6, 'fromHour': from_hour,
+                        'fromMinute': from_minute, 'toHour': to_hour, 'toMinute': to_minute}
 
             tou_periods.append(tou_slot)
 
         return tou_periods
 
+    # Build the Tesla API data structure for ToU slots, with separate periods for each day of the week, from
+    # the time slots in each band (see classify_slots) covering one or more days
+    @staticmethod
+    def build_weekly_tou_periods(band_slots):
+        clock = LocalTime.get_clock(LOCAL_TZ)
+
+        # The band of each local half hour of the week (day of week 0=Sunday, half hour 0-47). Later slots
+        # replace earlier ones, and half hours no slot falls in take the band of the latest slot at that time of day
+        week = [[None] * RateCache.DAY_SLOTS for _ in range(7)]
+        latest = [(-1, None)] * RateCache.DAY_SLOTS
+        for band in TOU_BANDS:
+            for valid_from in RateSchedule.of(band_slots[band]).values("valid_from"):
+                hour, minute = clock.hour_minute(valid_from)
+                half_hour = hour * 2 + minute // 30
+                week[clock.day_of_week(valid_from)][half_hour] = (valid_from, band)
+                if valid_from > latest[half_hour][0]:
+                    latest[half_hour] = (valid_from, band)
+        week = [[(cell or latest[half_hour])[1] for half_hour, cell in enumerate(day)] for day in week]
+
+        # Each run of half hours in the same band is one period (ending at 00:00 at the end of the day), and
+        # consecutive days of the week with the same periods share them
+        day_periods = [{band: [] for band in TOU_BANDS} for _ in range(7)]
+        for day_of_week, day in enumerate(week):
+            first = 0
+            for half_hour in range(1, RateCache.DAY_SLOTS + 1):
+                if half_hour < RateCache.DAY_SLOTS and day[half_hour] == day[first]:
+                    continue
+                if day[first] is not None:
+                    day_periods[day_of_week][day[first]].append((first // 2, first % 2 * 30,
+                                                                 half_hour // 2 % 24, half_hour % 2 * 30))
+                first = half_hour
+
+        tou_periods = {band: [] for band in TOU_BANDS}
+        from_day = 0
+        for day_of_week in range(1, 8):
+            if day_of_week < 7 and day_periods[day_of_week] == day_periods[from_day]:
+                continue
+            for band in TOU_BANDS:
+                for from_hour, from_minute, to_hour, to_minute in day_periods[from_day][band]:
+                    tou_periods[band].append({'fromDayOfWeek': from_day, 'toDayOfWeek': day_of_week - 1,
+                                              'fromHour': from_hour, 'fromMinute': from_minute,
+                                              'toHour': to_hour, 'toMinute': to_minute})
+            from_day = day_of_week
+        return tou_periods
+
     # Build the Tesla API data structure for Energy Costs
     @staticmethod
     def build_tou_rates(super_off_peak, off_peak, mid_peak, peak):
@@ -316,3 +662,56 @@ class Agile:
         print(f"[{name}Slots = {len(rate_array)}]")
         for item in rate_array:
             print(item)
+
+
+class Consumption:
+    # Half-hourly consumption of one electricity meter, streamed from the Octopus API into the local rate store.
+    # Consumption is only available to the account holder, so this needs the account's API key (see the
+    # Octopus developer dashboard), plus the meter's MPAN & serial number.
+
+    def __init__(self, logger, api_key, mpan, serial, cache, api_url=OCTOPUS_API_URL, client=None):
+        self._LOGGER = logger
+        self.api_key = api_key
+        self.mpan = mpan
+        self.serial = serial
+        self.cache = cache      # RateCache.RateCache holding the consumption
+        self.api_url = api_url
+        self.client = client    # OctopusClient.OctopusClient - the shared client is used when first needed
+
+    def stream(self, period_from, period_to=None):
+        # Yield each page of consumption from period_from (epoch seconds) as a time ordered list of
+        # (interval_start, interval_end, kWh) rows - one page is held in memory at a time
+        if self.client is None:
+            self.client = OctopusClient.get_client(self._LOGGER)
+
+        url = (f"{self.api_url}/electricity-meter-points/{self.mpan}/meters/{self.serial}/consumption/"
+               f"?period_from={LocalTime.to_utc_string(period_from)}&page_size={CONSUMPTION_PAGE_SIZE}"
+               f"&order_by=period")
+        if period_to is not None:
+            url += f"&period_to={LocalTime.to_utc_string(period_to)}"
+        self._LOGGER.info(f"Consumption.stream() - url ={url}")
+
+        # Follow the pagination links until the whole period has been returned
+        while url:
+            page = self.client.get_json(url, auth=(self.api_key, ""))
+            yield [(LocalTime.to_epoch(interval["interval_start"]), LocalTime.to_epoch(interval["interval_end"]),
+                    interval["consumption"]) for interval in page["results"]]
+            url = page.get("next")
+
+    def ingest(self, period_from, period_to=None):
+        # Store the consumption which isn't held locally yet - only the intervals after the latest one stored
+        # (or from period_from, for a new meter) are requested. Returns the number of intervals stored, or -1 if
+        # the fetch failed (any pages already stored are kept).
+        latest = self.cache.latest_consumption(self.mpan, self.serial)
+        if latest is not None:
+            period_from = max(period_from, latest)
+
+        interval_count = 0
+        try:
+            for rows in self.stream(period_from, period_to):
+                self.cache.put_consumption(self.mpan, self.serial, rows)
+                interval_count += len(rows)
+        except (OctopusClient.OctopusError, KeyError, TypeError) as e:
+            self._LOGGER.error(f"Consumption.ingest() - failed to fetch consumption for {self.mpan}: {e!r}")
+            return -1
+        return interval_count
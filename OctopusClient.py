@@ -0,0 +1,138 @@
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Shared HTTP client for the Octopus API: one pooled keep-alive session (gzip encoded responses), bounded
+# timeouts, retries with exponential backoff on connection errors, 429 and 5xx responses (honouring
+# Retry-After), and conditional requests - responses which carry an ETag or Last-Modified are revalidated
+# rather than downloaded again.
+
+DEFAULT_TIMEOUT = (5, 30)       # Seconds to connect, and to wait for each read
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5              # Seconds before the first retry, doubling on each retry
+BACKOFF_MAX = 30
+RETRY_AFTER_MAX = 120           # Longest Retry-After we are prepared to wait
+RETRY_STATUS = (429, 500, 502, 503, 504)
+POOL_SIZE = 16                  # Connections kept open - enough for the concurrent range & fleet fetches
+MAX_VALIDATORS = 256            # Responses held for conditional requests
+
+
+class OctopusError(Exception):
+    pass
+
+
+class OctopusClient:
+
+    def __init__(self, logger, timeout=DEFAULT_TIMEOUT, retries=MAX_RETRIES, pool_size=POOL_SIZE):
+        import requests     # Only loaded when something needs fetching - cached runs don't need it
+        from requests.adapters import HTTPAdapter
+
+        self._LOGGER = logger
+        self.requests = requests
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        self.session.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip"})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.validators = {}    # url -> (ETag, Last-Modified, payload) of the last response
+        self.lock = threading.Lock()
+
+    def get_json(self, url, metrics=None, auth=None):
+        # GET a JSON document, retrying transient failures - raises OctopusError if it can't be fetched.
+        # auth is the (API key, "") basic auth pair for account endpoints, e.g. meter consumption.
+        headers = {}
+        with self.lock:
+            cached = self.validators.get(url)
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                r = self.session.get(url, headers=headers, timeout=self.timeout, auth=auth)
+            except self.requests.RequestException as e:
+                if metrics is not None:
+                    metrics.record_http("octopus", "GET", "error", time.perf_counter() - start, 0)
+                # Connection failures, timeouts and responses cut off part way are retried - anything else (e.g.
+                # too many redirects) would fail again
+                transient = isinstance(e, (self.requests.ConnectionError, self.requests.Timeout,
+                                           self.requests.exceptions.ChunkedEncodingError,
+                                           self.requests.exceptions.ContentDecodingError))
+                if not transient or attempt == self.retries:
+                    raise OctopusError(f"Octopus API request failed: {e}") from e
+                self.__backoff(attempt, None, e)
+                continue
+
+            if metrics is not None:
+                metrics.record_http("octopus", "GET", r.status_code, time.perf_counter() - start, len(r.content))
+
+            if r.status_code == 304 and cached is not None:
+                return cached[2]
+
+            if r.status_code in RETRY_STATUS and attempt < self.retries:
+                self.__backoff(attempt, r.headers.get("Retry-After"), f"HTTP {r.status_code}")
+                continue
+
+            if r.status_code != 200:
+                raise OctopusError(f"Octopus API returned HTTP {r.status_code} for {url}")
+
+            try:
+                payload = r.json()
+            except ValueError as e:
+                raise OctopusError(f"Octopus API returned invalid JSON for {url}") from e
+
+            etag = r.headers.get("ETag")
+            last_modified = r.headers.get("Last-Modified")
+            if etag or last_modified:
+                with self.lock:
+                    if len(self.validators) >= MAX_VALIDATORS:
+                        del self.validators[next(iter(self.validators))]
+                    self.validators[url] = (etag, last_modified, payload)
+            return payload
+
+    def __backoff(self, attempt, retry_after, reason):
+        delay = retry_after_seconds(retry_after)
+        if delay is None:
+            # Exponential backoff with full jitter
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        self._LOGGER.warning(f"Octopus API request failed ({reason}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+    def close(self):
+        self.session.close()
+
+
+def retry_after_seconds(retry_after):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not retry_after:
+        return None
+    try:
+        seconds = float(retry_after)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), RETRY_AFTER_MAX)
+
+
+# One client (and connection pool) is shared by everything in the process
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client(logger):
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = OctopusClient(logger)
+        return _CLIENT
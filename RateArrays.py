@@ -0,0 +1,111 @@
+import os
+from array import array
+
+# Optional NumPy backend for the rate statistics, banding and merging of long rate series (e.g. months of
+# history). NumPy is imported the first time a large enough series is processed - a day's 48 slots are faster
+# in pure Python, and runs which never need it don't pay for the import. If NumPy isn't installed (or the
+# AGILEWALL_NUMPY environment variable is set to 0) the pure Python paths in Octopus are used.
+#
+# The results are identical to the pure Python paths: sums are accumulated slot by slot in the same order
+# (not NumPy's pairwise summation), and averages are rounded with Python's round().
+
+VECTOR_MIN_SLOTS = 2000     # Shorter series use the pure Python path
+
+_numpy = None
+_checked = False
+
+
+def numpy_module():
+    # NumPy, or None if it isn't available
+    global _numpy, _checked
+    if not _checked:
+        _checked = True
+        if os.environ.get("AGILEWALL_NUMPY", "1") != "0":
+            try:
+                import numpy
+                _numpy = numpy
+            except ImportError:
+                pass
+    return _numpy
+
+
+def enabled(slot_count):
+    return slot_count >= VECTOR_MIN_SLOTS and numpy_module() is not None
+
+
+def backend():
+    return f"numpy {_numpy.__version__}" if numpy_module() is not None else "python"
+
+
+def column(data, rows):
+    # NumPy view of a RateSchedule column (an array.array) for the given rows (a range or an array of row numbers)
+    values = _numpy.frombuffer(data, dtype=data.typecode)
+    if isinstance(rows, range):
+        return values[rows.start:rows.stop:rows.step]
+    return values[_numpy.frombuffer(rows, dtype=rows.typecode)]
+
+
+def to_array(typecode, values):
+    result = array(typecode)
+    result.frombytes(values.astype(typecode, copy=False).tobytes())
+    return result
+
+
+def sequential_sum(values):
+    # Slot by slot sum, as the pure Python loop adds them (cumulative sums are accumulated in order)
+    return float(_numpy.cumsum(values)[-1]) if len(values) else 0
+
+
+def price_stats(prices):
+    # (min, total, max) of a NumPy price column
+    return float(prices.min()), sequential_sum(prices), float(prices.max())
+
+
+def classify(schedule_rows, prices, thresholds, codes, tariff):
+    # Set each row's band code in tariff (codes[number of thresholds <= price]), and return the rows in each band
+    # (in row order) by code
+    np = _numpy
+    rows = np.arange(schedule_rows.start, schedule_rows.stop, schedule_rows.step) \
+        if isinstance(schedule_rows, range) else np.frombuffer(schedule_rows, dtype=schedule_rows.typecode)
+    band = np.searchsorted(np.asarray(thresholds, dtype=float), prices, side="right")
+    row_codes = np.asarray(codes, dtype="b")[band]
+    np.frombuffer(tariff, dtype=tariff.typecode)[rows] = row_codes
+    return {code: to_array('l', rows[row_codes == code]) for code in set(codes)}
+
+
+def merge_runs(valid_from, valid_to, price_exc, price_inc, tariff):
+    # Merge each run of adjacent slots (NumPy columns, in time order) into one slot with the average unit prices.
+    # Returns the merged columns as (valid_from, valid_to, price_exc, price_inc, tariff) arrays.
+    np = _numpy
+    slot_count = len(valid_from)
+    starts = np.ones(slot_count, dtype=bool)
+    starts[1:] = valid_from[1:] != valid_to[:-1]
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], slot_count) - 1
+    count = last - first + 1
+
+    # Add the prices of each run in slot order - the longest runs first, so the runs still being summed at
+    # each step are always a prefix
+    order = np.argsort(-count, kind="stable")
+    order_first = first[order]
+    order_count = count[order]
+    total_exc = price_exc[order_first].copy()
+    total_inc = price_inc[order_first].copy()
+    descending = -order_count
+    for step in range(1, int(order_count[0]) if len(order_count) else 0):
+        active = int(np.searchsorted(descending, -step, side="left"))
+        total_exc[:active] += price_exc[order_first[:active] + step]
+        total_inc[:active] += price_inc[order_first[:active] + step]
+
+    run_exc = np.empty_like(total_exc)
+    run_inc = np.empty_like(total_inc)
+    run_exc[order] = total_exc
+    run_inc[order] = total_inc
+
+    # Single slots keep their price, runs take the average rounded to 3 decimals
+    merged_exc = array('d', [price if n == 1 else round(price / n, 3)
+                             for price, n in zip(run_exc.tolist(), count.tolist())])
+    merged_inc = array('d', [price if n == 1 else round(price / n, 3)
+                             for price, n in zip(run_inc.tolist(), count.tolist())])
+    return (to_array('q', valid_from[first]), to_array('q', valid_to[last]), merged_exc, merged_inc,
+            to_array('b', tariff[first]))
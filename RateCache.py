@@ -0,0 +1,171 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+import LocalTime
+
+# Local on-disk store for Octopus Agile rates.
+# Published Agile prices never change, so once a half-hour slot has been fetched it can be
+# served from here indefinitely - the only eviction is the size cap (first stored, first evicted).
+# The same file also holds each meter's half-hourly consumption, and the daily costs worked out from it
+# (see Costs.py) - these aren't evicted.
+
+DEFAULT_CACHE_FILE = "agile_cache.db"
+DEFAULT_MAX_SLOTS = 500000      # ~28 years of half-hour slots for a single tariff/area
+SLOT_SECONDS = 30 * 60
+DAY_SLOTS = LocalTime.DAY_SECONDS // SLOT_SECONDS     # Half-hour slots in a 24 hour day - see period_slots()
+AGILE_DAY_START = 23 * 60 * 60      # The Agile day runs 23:00 -> 23:00 UK local time
+
+
+class RateCache:
+
+    def __init__(self, file_name=DEFAULT_CACHE_FILE, max_slots=DEFAULT_MAX_SLOTS):
+        self.file_name = file_name
+        self.max_slots = max_slots
+        self.hits = 0
+        self.misses = 0
+
+        # One connection shared by every caller in the process, serialised by a lock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(file_name, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS rates ("
+                         "tariff TEXT NOT NULL, area TEXT NOT NULL, valid_from INTEGER NOT NULL, "
+                         "valid_to INTEGER NOT NULL, price_exc REAL NOT NULL, price_inc REAL NOT NULL, "
+                         "PRIMARY KEY (tariff, area, valid_from))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS consumption ("
+                         "mpan TEXT NOT NULL, serial TEXT NOT NULL, interval_start INTEGER NOT NULL, "
+                         "interval_end INTEGER NOT NULL, kwh REAL NOT NULL, "
+                         "PRIMARY KEY (mpan, serial, interval_start))")
+        # Cost of each Agile day's consumption in each band - cost at the Agile price of each slot, and at the
+        # band's single (Powerwall) rate - for a tariff / area / banding strategy
+        self._db.execute("CREATE TABLE IF NOT EXISTS costs ("
+                         "mpan TEXT NOT NULL, serial TEXT NOT NULL, tariff TEXT NOT NULL, area TEXT NOT NULL, "
+                         "strategy TEXT NOT NULL, day INTEGER NOT NULL, band TEXT NOT NULL, "
+                         "slots INTEGER NOT NULL, kwh REAL NOT NULL, cost REAL NOT NULL, band_cost REAL NOT NULL, "
+                         "PRIMARY KEY (mpan, serial, tariff, area, strategy, day, band))")
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_rates(self, tariff_code, area_code, period_from, period_to):
+        # Returns the cached rows [(valid_from, valid_to, price_exc, price_inc), ...] inside the period
+        # (epoch seconds, time ordered) and the list of half-hour slot starts which are not cached yet.
+        with self._lock:
+            rows = self._db.execute("SELECT valid_from, valid_to, price_exc, price_inc FROM rates "
+                                    "WHERE tariff=? AND area=? AND valid_from>=? AND valid_from<? "
+                                    "ORDER BY valid_from",
+                                    (tariff_code, area_code, period_from, period_to)).fetchall()
+
+            cached = {row[0] for row in rows}
+            missing = [slot for slot in range(period_from, period_to, SLOT_SECONDS) if slot not in cached]
+
+            self.hits += len(rows)
+            self.misses += len(missing)
+        return rows, missing
+
+    def put_rates(self, tariff_code, area_code, rows):
+        # rows: iterable of (valid_from, valid_to, price_exc, price_inc) in epoch seconds
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO rates VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(tariff_code, area_code) + tuple(row) for row in rows])
+            self._db.commit()
+        self.evict()
+
+    def put_consumption(self, mpan, serial, rows):
+        # rows: iterable of (interval_start, interval_end, kWh) in epoch seconds
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO consumption VALUES (?, ?, ?, ?, ?)",
+                                 [(mpan, serial) + tuple(row) for row in rows])
+            self._db.commit()
+
+    def get_consumption(self, mpan, serial, period_from, period_to):
+        # Returns the stored rows [(interval_start, interval_end, kWh), ...] starting inside the period, time ordered
+        with self._lock:
+            return self._db.execute("SELECT interval_start, interval_end, kwh FROM consumption "
+                                    "WHERE mpan=? AND serial=? AND interval_start>=? AND interval_start<? "
+                                    "ORDER BY interval_start", (mpan, serial, period_from, period_to)).fetchall()
+
+    def consumption_bounds(self, mpan, serial):
+        # (first interval start, last interval end) of the stored consumption, or (None, None)
+        with self._lock:
+            return self._db.execute("SELECT MIN(interval_start), MAX(interval_end) FROM consumption "
+                                    "WHERE mpan=? AND serial=?", (mpan, serial)).fetchone()
+
+    def latest_consumption(self, mpan, serial):
+        return self.consumption_bounds(mpan, serial)[1]
+
+    def put_costs(self, key, day, rows):
+        # key: (mpan, serial, tariff, area, strategy), rows: iterable of (band, slots, kWh, cost, band cost)
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO costs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 [tuple(key) + (day,) + tuple(row) for row in rows])
+            self._db.commit()
+
+    def last_costed_day(self, key):
+        with self._lock:
+            return self._db.execute("SELECT MAX(day) FROM costs WHERE mpan=? AND serial=? AND tariff=? AND area=? "
+                                    "AND strategy=?", tuple(key)).fetchone()[0]
+
+    def get_costs(self, key, period_from, period_to, by_day=False):
+        # Cost totals by band (and by day) for the Agile days starting inside the period:
+        # [(day or None, band, slots, kWh, cost, band cost), ...]
+        day = "day" if by_day else "NULL"
+        with self._lock:
+            return self._db.execute(f"SELECT {day}, band, SUM(slots), SUM(kwh), SUM(cost), SUM(band_cost) "
+                                    "FROM costs WHERE mpan=? AND serial=? AND tariff=? AND area=? AND strategy=? "
+                                    f"AND day>=? AND day<? GROUP BY {day}, band ORDER BY {day}, band",
+                                    tuple(key) + (period_from, period_to)).fetchall()
+
+    def slot_count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM rates").fetchone()[0]
+
+    def evict(self):
+        # Size policy: once over the cap, drop the slots which were stored first (across all tariffs/areas)
+        excess = self.slot_count() - self.max_slots
+        if excess <= 0:
+            return 0
+
+        with self._lock:
+            self._db.execute("DELETE FROM rates WHERE rowid IN "
+                             "(SELECT rowid FROM rates ORDER BY rowid LIMIT ?)", (excess,))
+            self._db.commit()
+        return excess
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "slots": self.slot_count(), "max_slots": self.max_slots}
+
+
+def period_bounds(start_day, days=1):
+    # UTC epochs of 23:00 UK local time on start_day, and `days` days later - the Agile day runs 23:00 -> 23:00
+    # local time, so it starts at 22:00 UTC in summer, and is 23 or 25 hours long over a clock change
+    return _day_start(start_day), _day_start(start_day + timedelta(days=days))
+
+
+def _day_start(day):
+    # 23:00 local time on the day - the clocks change in the early morning, so the UTC offset at 23:00 on the
+    # wall clock (read as UTC) is the offset at 23:00 local time
+    wall_clock = int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp()) + AGILE_DAY_START
+    return wall_clock - LocalTime.get_clock().utc_offset(wall_clock)
+
+
+def period_slots(period_from, period_to):
+    # Half-hour slots in a period - 46 or 50 for an Agile day over a clock change
+    return (period_to - period_from) // SLOT_SECONDS
+
+
+def agile_day_bounds(epoch):
+    # (start, end) UTC epochs of the Agile day holding a UTC epoch
+    local_epoch = LocalTime.get_clock().local_epoch(epoch)
+    return period_bounds(datetime.fromtimestamp(local_epoch - AGILE_DAY_START, timezone.utc).date())
+
+
+def agile_day_start(epoch):
+    # Start of the Agile day holding a UTC epoch
+    return agile_day_bounds(epoch)[0]
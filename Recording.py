@@ -0,0 +1,221 @@
+import gzip
+import json
+import time
+import threading
+import Files
+import OctopusClient
+from datetime import date
+
+# Records the Octopus API responses and the Tesla battery list & get_tariff / set_tariff payloads of AgileWall runs
+# to a compact (gzipped JSON) file, and replays them through the same Octopus.Agile client and Tesla.Powerwall
+# session interfaces - so a run can be profiled, benchmarked or reproduced without network access, e.g.
+#
+#     python AgileWall.py -t AGILE-23-12-06 -a C -i me@example.com --record run.json.gz
+#     python AgileWall.py -t AGILE-23-12-06 -a C -i me@example.com --replay run.json.gz --replay_latency 250
+#
+# Each call is replayed in the order it was recorded (the last response is repeated once they run out), with
+# either the latency recorded for it or a fixed latency.
+
+FORMAT_VERSION = 1
+RECORDED = "recorded"       # Replay each call with the latency it was recorded with
+
+
+class RecordingError(Exception):
+    pass
+
+
+class Recording:
+
+    def __init__(self, data=None):
+        self.data = data or {"version": FORMAT_VERSION, "recorded_at": time.time(), "tariff_state": {},
+                             "octopus": {}, "tesla": {"battery_list": [], "get_tariff": [], "set_tariff": []}}
+        self.lock = threading.Lock()
+        self.positions = {}     # Replay position of each call sequence
+
+    @classmethod
+    def load(cls, file_name):
+        try:
+            with gzip.open(file_name, "rt") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise RecordingError(f"Can't read the recording {file_name}: {e}") from e
+        if data.get("version") != FORMAT_VERSION:
+            raise RecordingError(f"Recording {file_name} is format version {data.get('version')}, "
+                                 f"expected {FORMAT_VERSION}")
+        return cls(data)
+
+    def save(self, file_name):
+        with self.lock:
+            text = json.dumps(self.data, separators=(",", ":"))
+        Files.atomic_write(file_name, text, gzip.open)
+
+    def add(self, sequence, call):
+        with self.lock:
+            sequence.append(call)
+
+    def next(self, key, sequence):
+        # The next recorded call of a sequence - the last one is repeated once they have all been replayed
+        if not sequence:
+            return None
+        with self.lock:
+            position = self.positions.get(key, 0)
+            self.positions[key] = position + 1
+        return sequence[min(position, len(sequence) - 1)]
+
+    def today(self):
+        # The recorded run's date - a replay fetches the same days (so the same URLs) whenever it is run
+        return date.fromtimestamp(self.data["recorded_at"])
+
+    # Octopus API
+
+    def recording_client(self, client):
+        return RecordingClient(client, self)
+
+    def replay_client(self, latency=RECORDED):
+        return ReplayClient(self, latency)
+
+    # Tesla API
+
+    def recording_tesla(self, tesla):
+        return RecordingTesla(tesla, self)
+
+    def replay_tesla(self, latency=RECORDED):
+        return ReplayTesla(self, latency)
+
+
+def _pause(latency, call):
+    # Latency is RECORDED, or a fixed number of milliseconds
+    seconds = call.get("seconds", 0) if latency == RECORDED else latency / 1000
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+class RecordingClient:
+    # Stands in for an OctopusClient, recording each response (or failure) it returns
+
+    def __init__(self, client, recording):
+        self.client = client
+        self.recording = recording
+
+    def get_json(self, url, metrics=None, auth=None):
+        # The API key (auth) isn't recorded
+        with self.recording.lock:
+            calls = self.recording.data["octopus"].setdefault(url, [])
+        start = time.perf_counter()
+        try:
+            payload = self.client.get_json(url, metrics, auth)
+        except OctopusClient.OctopusError as e:
+            self.recording.add(calls, {"seconds": round(time.perf_counter() - start, 6), "error": str(e)})
+            raise
+        self.recording.add(calls, {"seconds": round(time.perf_counter() - start, 6), "payload": payload})
+        return payload
+
+
+class ReplayClient:
+    # Stands in for an OctopusClient, serving the recorded responses
+
+    def __init__(self, recording, latency=RECORDED):
+        self.recording = recording
+        self.latency = latency
+
+    def get_json(self, url, metrics=None, auth=None):
+        call = self.recording.next(("octopus", url), self.recording.data["octopus"].get(url))
+        if call is None:
+            raise OctopusClient.OctopusError(f"No recorded response for {url}")
+
+        start = time.perf_counter()
+        _pause(self.latency, call)
+        if "error" in call:
+            if metrics is not None:
+                metrics.record_http("octopus", "GET", "error", time.perf_counter() - start, 0)
+            raise OctopusClient.OctopusError(call["error"])
+        if metrics is not None:
+            metrics.record_http("octopus", "GET", 200, time.perf_counter() - start,
+                                len(json.dumps(call["payload"], separators=(",", ":"))))
+        return call["payload"]
+
+
+class RecordingTesla:
+    # Wraps a teslapy.Tesla session, recording the battery list and each battery's tariff reads & writes
+
+    def __init__(self, tesla, recording):
+        self.tesla = tesla
+        self.recording = recording
+
+    def __getattr__(self, name):
+        # Sign on (authorized, authorization_url, fetch_token), close etc. go straight to the session
+        return getattr(self.tesla, name)
+
+    def battery_list(self):
+        start = time.perf_counter()
+        batteries = self.tesla.battery_list()
+        self.recording.add(self.recording.data["tesla"]["battery_list"],
+                           {"seconds": round(time.perf_counter() - start, 6),
+                            "batteries": [dict(battery) for battery in batteries]})
+        return [RecordingBattery(battery, self.recording) for battery in batteries]
+
+
+class RecordingBattery(dict):
+
+    def __init__(self, battery, recording):
+        super().__init__(battery)
+        self.battery = battery
+        self.recording = recording
+
+    def get_tariff(self):
+        start = time.perf_counter()
+        tariff = self.battery.get_tariff()
+        # A copy - AgileWall updates the tariff it reads in place
+        self.recording.add(self.recording.data["tesla"]["get_tariff"],
+                           {"seconds": round(time.perf_counter() - start, 6), "tariff": json.loads(json.dumps(tariff))})
+        return tariff
+
+    def set_tariff(self, tariff):
+        start = time.perf_counter()
+        response = self.battery.set_tariff(tariff)
+        self.recording.add(self.recording.data["tesla"]["set_tariff"],
+                           {"seconds": round(time.perf_counter() - start, 6),
+                            "tariff": json.loads(json.dumps(tariff)), "response": response})
+        return response
+
+
+class ReplayTesla:
+    # Stands in for a signed on teslapy.Tesla session, serving the recorded batteries & tariffs
+    authorized = True
+
+    def __init__(self, recording, latency=RECORDED):
+        self.recording = recording
+        self.latency = latency
+
+    def battery_list(self):
+        call = self.recording.next(("tesla", "battery_list"), self.recording.data["tesla"]["battery_list"])
+        if call is None:
+            raise RecordingError("No Tesla battery list in the recording")
+        _pause(self.latency, call)
+        return [ReplayBattery(battery, self) for battery in call["batteries"]]
+
+    def close(self):
+        pass
+
+
+class ReplayBattery(dict):
+
+    def __init__(self, battery, tesla):
+        super().__init__(battery)
+        self.tesla = tesla
+
+    def get_tariff(self):
+        recording = self.tesla.recording
+        call = recording.next(("tesla", "get_tariff"), recording.data["tesla"]["get_tariff"])
+        if call is None:
+            raise RecordingError("No Powerwall tariff in the recording")
+        _pause(self.tesla.latency, call)
+        return json.loads(json.dumps(call["tariff"]))
+
+    def set_tariff(self, tariff):
+        # The tariff isn't sent anywhere - the recorded response (or "Updated" if the recorded run didn't send
+        # one) is returned
+        recording = self.tesla.recording
+        call = recording.next(("tesla", "set_tariff"), recording.data["tesla"]["set_tariff"]) or {}
+        _pause(self.tesla.latency, call)
+        return call.get("response", "Updated")
@@ -0,0 +1,59 @@
+import math
+import random
+import LocalTime
+import RateCache
+import Octopus
+
+# Generates realistic looking Agile prices for benchmarks and offline testing.
+# Each Agile day (23:00 -> 23:00 UK local time) is generated from its own seeded random generator, so any slot can be
+# regenerated on its own and every day is the same whichever range it is requested as part of.
+
+VAT = 1.05
+AGILE_CAP = 100.0           # Agile import price cap (pence, inc VAT)
+
+
+def day_rows(day_from, day_to, seed=0):
+    # Rows of (valid_from, valid_to, price_exc, price_inc) for the Agile day from epoch day_from to day_to - 48,
+    # or 46 or 50 over a clock change
+    rng = random.Random(seed * 1000003 + day_from // LocalTime.DAY_SECONDS)
+    windy = rng.random()            # Windy days push prices down, occasionally negative overnight
+    spike = rng.uniform(8, 25)      # Size of the evening peak
+    level = rng.uniform(-3, 5)      # Day to day shift of the whole curve
+
+    rows = []
+    for valid_from in range(day_from, day_to, RateCache.SLOT_SECONDS):
+        hour = (valid_from % LocalTime.DAY_SECONDS) / 3600
+        price = 16 + level + 5 * math.sin((hour - 9) / 24 * 2 * math.pi) - windy * 10 + rng.gauss(0, 1.5)
+        if 16 <= hour < 19:
+            price += spike
+        if windy > 0.85 and hour < 6:
+            price -= rng.uniform(5, 15)
+        price_inc = round(min(price, AGILE_CAP), 2)
+        rows.append((valid_from, valid_from + RateCache.SLOT_SECONDS, round(price_inc / VAT, 3), price_inc))
+    return rows
+
+
+def synthetic_rows(period_from, period_to, seed=0):
+    # Time ordered rows for every slot from period_from up to (not including) period_to
+    day_from = RateCache.agile_day_start(period_from)
+    while day_from < period_to:
+        day_to = RateCache.agile_day_bounds(day_from)[1]
+        for row in day_rows(day_from, day_to, seed):
+            if period_from <= row[0] < period_to:
+                yield row
+        day_from = day_to
+
+
+def synthetic_schedule(start_day, days=1, seed=0):
+    period_from, period_to = RateCache.period_bounds(start_day, days)
+    return Octopus.RateSchedule.from_rows(synthetic_rows(period_from, period_to, seed))
+
+
+def octopus_results(period_from, period_to, seed=0):
+    # The rows as the Octopus standard-unit-rates API returns them - newest first
+    rows = list(synthetic_rows(period_from, period_to, seed))
+    rows.reverse()
+    return [{"value_exc_vat": price_exc, "value_inc_vat": price_inc,
+             "valid_from": LocalTime.to_utc_string(valid_from), "valid_to": LocalTime.to_utc_string(valid_to),
+             "payment_method": None}
+            for valid_from, valid_to, price_exc, price_inc in rows]
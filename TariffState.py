@@ -0,0 +1,75 @@
+import os
+import json
+import hashlib
+import threading
+import Files
+import Octopus
+
+# Tracks what was last sent to each Powerwall, so unchanged schedules aren't written again.
+# The Powerwall tariff sections we manage (energy charges & ToU periods for one season) are normalised into a
+# canonical form, which can be compared with the tariff read from Tesla and hashed for the state file.
+
+DEFAULT_STATE_FILE = "agilewall_state.json"
+PERIOD_KEYS = ("fromDayOfWeek", "toDayOfWeek", "fromHour", "fromMinute", "toHour", "toMinute")
+
+
+def normalise(tou_rates, tou_periods):
+    return {"energy_charges": {band: round(float(tou_rates.get(band, 0)), 2) for band in Octopus.TOU_BANDS},
+            "tou_periods": {band: sorted([period.get(key, 0) for key in PERIOD_KEYS]
+                                         for period in tou_periods.get(band, []))
+                            for band in Octopus.TOU_BANDS}}
+
+
+def tariff_section(battery_tariff, season="Summer"):
+    # Normalised form of the sections of a Powerwall tariff which AgileWall updates
+    energy_charges = battery_tariff.get("energy_charges", {}).get(season, {})
+    tou_periods = battery_tariff.get("seasons", {}).get(season, {}).get("tou_periods", {})
+    return normalise(energy_charges, tou_periods)
+
+
+def digest(normalised):
+    return hashlib.sha256(json.dumps(normalised, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def _format_periods(periods):
+    return ", ".join(f"{from_hour:02}:{from_minute:02}-{to_hour:02}:{to_minute:02}"
+                     for _, _, from_hour, from_minute, to_hour, to_minute in periods) or "-"
+
+
+def diff(current, new):
+    # Compact, one line per change, description of the differences between two normalised tariffs
+    changes = []
+    for band in Octopus.TOU_BANDS:
+        if current["energy_charges"][band] != new["energy_charges"][band]:
+            changes.append(f"{band} rate: {current['energy_charges'][band]} -> {new['energy_charges'][band]}")
+        if current["tou_periods"][band] != new["tou_periods"][band]:
+            changes.append(f"{band} periods: {_format_periods(current['tou_periods'][band])} -> "
+                           f"{_format_periods(new['tou_periods'][band])}")
+    return changes
+
+
+class TariffState:
+    # Last pushed tariff digest for each Powerwall, persisted as JSON - or only held in memory if there is no
+    # file name (e.g. replayed runs, which mustn't change what is recorded for the real Powerwall)
+
+    def __init__(self, file_name=DEFAULT_STATE_FILE, state=None):
+        self.file_name = file_name
+        self._lock = threading.Lock()
+        self.state = dict(state or {})
+        if file_name and os.path.exists(file_name):
+            with open(file_name) as f:
+                self.state = json.load(f)
+
+    @staticmethod
+    def key(tesla_id, battery_id=None):
+        return f"{tesla_id}/{battery_id or 'default'}"
+
+    def get_digest(self, key):
+        return self.state.get(key)
+
+    def set_digest(self, key, tariff_digest):
+        with self._lock:
+            self.state[key] = tariff_digest
+            if not self.file_name:
+                return
+            Files.atomic_write(self.file_name, json.dumps(self.state, indent=4))
@@ -1,31 +1,67 @@
-import teslapy
-
-
 class Powerwall:
+    # Holds one authenticated Tesla session, and the selected battery, for the lifetime of the process.
+    # TeslaPy refreshes the access token on this session only when it has expired.
 
-    def __init__(self, tesla_id):
+    def __init__(self, tesla_id, interactive=True, battery_id=None, tesla=None):
         self.tesla_id = tesla_id
 
-        tesla = teslapy.Tesla(self.tesla_id)
-        if not tesla.authorized:
+        # An existing teslapy.Tesla compatible session can be supplied (e.g. a stand-in for benchmarks)
+        if tesla is None:
+            import teslapy
+            tesla = teslapy.Tesla(self.tesla_id)
+        self.tesla = tesla
+        if not self.tesla.authorized:
+            # Unattended callers (e.g. fleet mode) can't complete the SSO logon at the console
+            if not interactive:
+                self.tesla.close()
+                raise PermissionError(f"Tesla ID {self.tesla_id} has no cached token - run AgileWall.py once "
+                                      f"interactively to sign on.")
             print('Use browser to login. "Page Not Found" will be shown on success.')
-            print('Open this URL: ' + tesla.authorization_url())
-            tesla.fetch_token(authorization_response=input('Enter URL after authentication: '))
-        batteries = tesla.battery_list()
-        print(batteries[0])
-        
+            print('Open this URL: ' + self.tesla.authorization_url())
+            self.tesla.fetch_token(authorization_response=input('Enter URL after authentication: '))
+
+        self.battery = self.__select_battery(battery_id)
+        print(self.battery)
+
+    def __select_battery(self, battery_id):
+        # Pick the target battery by its id, energy site id or site name - or the first battery if not specified
+        batteries = self.tesla.battery_list()
+        if not batteries:
+            raise LookupError(f"No Powerwall batteries found for Tesla ID {self.tesla_id}")
+
+        if battery_id is None:
+            return batteries[0]
+
+        for battery in batteries:
+            if battery_id in (str(battery.get("id")), str(battery.get("energy_site_id")), battery.get("site_name")):
+                return battery
+
+        raise LookupError(f"Battery {battery_id} not found for Tesla ID {self.tesla_id}, available: " +
+                          ", ".join(f"{battery.get('site_name')} ({battery.get('energy_site_id')})"
+                                    for battery in batteries))
+
+    def close(self):
+        self.tesla.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
     def get_tariff(self):
         # Powerwall API returns schedule data in local time (DST or non-DST)
-
-        with teslapy.Tesla(self.tesla_id) as tesla:
-            batteries = tesla.battery_list()
-            tariff = batteries[0].get_tariff()
-        return tariff
+        return self.battery.get_tariff()
 
     def set_tariff(self, battery_tariff):
         # Powerwall API returns schedule data in local time (DST or non-DST)
+        return self.battery.set_tariff(battery_tariff)
 
-        with teslapy.Tesla(self.tesla_id) as tesla:
-            batteries = tesla.battery_list()
-            res = batteries[0].set_tariff(battery_tariff)
-        return res
+    @staticmethod
+    def update_tariff(battery_tariff, tou_rates, tou_periods, season="Summer"):
+        # The Update API takes the entire tariff configuration structure as input, so update
+        # only the sections we care about - all other config options in this structure are unchanged
+        battery_tariff["energy_charges"][season] = tou_rates
+        for band, periods in tou_periods.items():
+            battery_tariff["seasons"][season]["tou_periods"][band] = periods
+        return battery_tariff
@@ -0,0 +1,149 @@
+from array import array
+
+# Band thresholds. The default heuristic (heuristic_limits) derives the three thresholds from fixed fractions of
+# the average, minimum & maximum prices. The optimal search (optimal_limits) instead chooses the three
+# breakpoints over the sorted prices which best trade price fidelity against the number of Tesla ToU periods.
+# The cost of a banding is
+#
+#     sum over bands of the squared deviation of each slot's price from its band's average price (pence^2)
+#   + period_penalty * number of ToU periods after adjacent slots in the same band are merged
+#
+# which is a natural breaks (Jenks) optimisation with an extra term for the periods. The period count splits
+# into a sum over the bands (each pair of adjacent slots in the same band saves a period), so the optimum is
+# found exactly by dynamic programming over the price buckets.
+
+HEURISTIC = "heuristic"
+OPTIMAL = "optimal"
+STRATEGIES = (HEURISTIC, OPTIMAL)
+
+DEFAULT_FACTORS = (0.9, 0.9, 1.0)   # Heuristic (super off-peak, off-peak, mid-peak) threshold factors
+DEFAULT_PERIOD_PENALTY = 20.0       # pence^2 of price error worth one extra ToU period
+BUCKET_SIZE = 0.1                   # Prices are bucketed to 0.1p - thresholds only fall between buckets
+MAX_GROUPS = 240                    # Long histories: buckets are grouped to bound the search at O(MAX_GROUPS^2)
+BANDS = 4
+
+
+def heuristic_limits(rate_min, rate_avg, rate_max, factors=DEFAULT_FACTORS):
+    # Create the band limits
+    super_off_peak_factor, off_peak_factor, mid_peak_factor = factors
+    # The split between Super Off-Peak and Off-Peak rates is the midway point between average and min rate value
+    # 24-03-16: Initial testing suggests that we need to constrain the Super Off-Peak price band further, so we
+    #           can select only the cheapest prices when the lower price spread is constrained
+    limit_super_off_peak = (((rate_avg - rate_min) / 2) + rate_min) * super_off_peak_factor
+    # The split between Off-Peak and Mid-Peak rates is the average rate value
+    # 24-03-16: Trying a similar constraint of the Off-Peak price band further so we
+    limit_off_peak = rate_avg * off_peak_factor
+    # The Peak / Mid-Peak split is calculated as all rates below 50% of the max value
+    limit_mid_peak = (((rate_max - rate_avg) / 2) + rate_avg) * mid_peak_factor
+    return limit_super_off_peak, limit_off_peak, limit_mid_peak
+
+
+def optimal_limits(valid_from, valid_to, prices, period_penalty=DEFAULT_PERIOD_PENALTY):
+    # Returns the (super off-peak, off-peak, mid-peak) thresholds for time ordered slots, or None if the prices
+    # can't be split into 4 bands
+    groups = _price_groups(prices)
+    group_count = max(groups) + 1 if groups else 0
+    if group_count < BANDS:
+        return None
+
+    # Per group slot count, price sums & the price range - with prefix sums for the band costs
+    count = [0] * group_count
+    total = [0.0] * group_count
+    lowest = [float("inf")] * group_count
+    highest = [float("-inf")] * group_count
+    for group, price in zip(groups, prices):
+        count[group] += 1
+        total[group] += price
+        lowest[group] = min(lowest[group], price)
+        highest[group] = max(highest[group], price)
+
+    count_sum = [0] * (group_count + 1)
+    price_sum = [0.0] * (group_count + 1)
+    square_sum = [0.0] * (group_count + 1)
+    for group in range(group_count):
+        count_sum[group + 1] = count_sum[group] + count[group]
+        price_sum[group + 1] = price_sum[group] + total[group]
+    for group, price in zip(groups, prices):
+        square_sum[group + 1] += price * price
+    for group in range(group_count):
+        square_sum[group + 1] += square_sum[group]
+
+    joined = _joined_pairs(valid_from, valid_to, groups, group_count)
+
+    def band_cost(first, end):
+        # Squared error of the band holding groups [first, end), less the periods saved by merging within it
+        n = count_sum[end] - count_sum[first]
+        s = price_sum[end] - price_sum[first]
+        return square_sum[end] - square_sum[first] - s * s / n - period_penalty * joined[first][end]
+
+    # best[band][end] = lowest cost of splitting groups [0, end) into band + 1 bands
+    best = [[float("inf")] * (group_count + 1) for _ in range(BANDS)]
+    start = [[0] * (group_count + 1) for _ in range(BANDS)]
+    for end in range(1, group_count + 1):
+        best[0][end] = band_cost(0, end)
+    for band in range(1, BANDS):
+        previous = best[band - 1]
+        for end in range(band + 1, group_count + 1):
+            cost, first = min((previous[first] + band_cost(first, end), first) for first in range(band, end))
+            best[band][end] = cost
+            start[band][end] = first
+
+    # Walk back through the chosen band starts, placing each threshold midway across the gap between bands
+    limits = []
+    end = group_count
+    for band in range(BANDS - 1, 0, -1):
+        first = start[band][end]
+        limits.append((highest[first - 1] + lowest[first]) / 2)
+        end = first
+    limits.reverse()
+    return tuple(limits)
+
+
+def _price_groups(prices):
+    # Map each slot to its price group: the 0.1p buckets in price order, combined into at most MAX_GROUPS
+    # groups holding similar numbers of slots
+    buckets = [round(price / BUCKET_SIZE) for price in prices]
+    distinct = sorted(set(buckets))
+    if len(distinct) <= MAX_GROUPS:
+        index = {bucket: position for position, bucket in enumerate(distinct)}
+        return array('l', [index[bucket] for bucket in buckets])
+
+    bucket_count = {}
+    for bucket in buckets:
+        bucket_count[bucket] = bucket_count.get(bucket, 0) + 1
+
+    index = {}
+    seen = 0
+    group = -1
+    last_quantile = -1
+    for bucket in distinct:
+        quantile = seen * MAX_GROUPS // len(buckets)
+        if quantile != last_quantile:
+            group += 1
+            last_quantile = quantile
+        index[bucket] = group
+        seen += bucket_count[bucket]
+    return array('l', [index[bucket] for bucket in buckets])
+
+
+def _joined_pairs(valid_from, valid_to, groups, group_count):
+    # joined[first][end] = number of adjacent slot pairs with both slots' groups in [first, end) - i.e. the
+    # pairs which are merged into one ToU period if [first, end) is a band
+    by_highest = [[] for _ in range(group_count)]
+    for position in range(1, len(groups)):
+        if valid_to[position - 1] == valid_from[position]:
+            low, high = sorted((groups[position - 1], groups[position]))
+            by_highest[high].append(low)
+
+    joined = [[0] * (group_count + 1) for _ in range(group_count + 1)]
+    for high in range(group_count):
+        # Pairs whose higher group is `high`, counted by the lowest band start which still contains them
+        at_least = [0] * (group_count + 1)
+        for low in by_highest[high]:
+            at_least[low] += 1
+        for first in range(high - 1, -1, -1):
+            at_least[first] += at_least[first + 1]
+
+        for first in range(high + 1):
+            joined[first][high + 1] = joined[first][high] + at_least[first]
+    return joined